@@ -0,0 +1,129 @@
+"""
+Monte Carlo batches of independent games, played across a pool of processes.
+
+A lineup is a function taking no arguments that returns a Layout with players added,
+ready to run (e.g. sandbox.lineup). It must be defined at module level so it can be
+sent to worker processes.
+
+Usage: python batch.py ngames [--seed SEED] [--workers N]
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import os
+import numpy as np
+
+def game_seeds(seed,ngames):
+    """
+    Independent per-game seeds (np.random.SeedSequence) spawned from one batch seed.
+    Game i always gets the same seed, whichever worker plays it.
+    """
+    return np.random.SeedSequence(seed).spawn(ngames)
+
+def seed_of(result):
+    """
+    The seed a game was played with, from its result.
+    """
+    entropy, spawn_key = result['seed']
+    return np.random.SeedSequence(entropy,spawn_key=spawn_key)
+
+def rerun(lineup,result,display=True,replay_dir=None):
+    """
+    Play a game from a batch again, from the seed in its result.
+    """
+    layout=lineup()
+    layout.reseed(seed_of(result))
+    return layout.run_game(display=display,replay_dir=replay_dir)
+
+def play_game(lineup,seed,igame=0,replay_dir=None,quiet=True):
+    """
+    Play one game of the lineup.
+
+    Parameters
+    ----------
+    lineup : function returning a Layout ready to run
+    seed : np.random.SeedSequence for the game
+    igame : number of the game in its batch
+    replay_dir : if not None, the replay is streamed to a game_<igame> directory in here
+    quiet : suppress anything printed during the game
+
+    Returns
+    -------
+    The Layout.result dict of the game, with the game number and the seed, as
+    (entropy, spawn_key), added.
+    """
+    layout=lineup()
+    layout.reseed(seed)
+    game_dir=None
+    if replay_dir is not None:
+        game_dir=os.path.join(replay_dir,'game_%05d' % igame)
+        os.makedirs(game_dir,exist_ok=True)
+    with open(os.devnull,'w') as devnull:
+        out = devnull if quiet else None
+        with contextlib.redirect_stdout(out):
+            result=layout.run_game(display=False,replay_dir=game_dir)
+    result['seed']=(seed.entropy,seed.spawn_key)
+    result['game']=igame
+    return result
+
+def run_batch(lineup,ngames,seed=0,max_workers=None,replay_dir=None,quiet=True):
+    """
+    Play ngames independent games of a lineup, spread over a process pool.
+
+    Parameters
+    ----------
+    lineup : function returning a Layout ready to run
+    ngames : number of games
+    seed : batch seed, from which each game's seed is spawned
+    max_workers : number of processes, defaults to the number of CPUs. With 1, games are
+                  played in this process.
+    replay_dir : if not None, write each game's replay under here
+    quiet : suppress anything printed during the games
+
+    Returns
+    -------
+    Aggregated outcomes, see aggregate.
+    """
+    seeds=game_seeds(seed,ngames)
+    games=range(ngames)
+    args=([lineup]*ngames,seeds,games,[replay_dir]*ngames,[quiet]*ngames)
+    if max_workers == 1:
+        results=list(map(play_game,*args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            chunksize=max(1,ngames//(4*(max_workers or os.cpu_count() or 1)))
+            results=list(pool.map(play_game,*args,chunksize=chunksize))
+    return aggregate(results)
+
+def aggregate(results):
+    """
+    Summarise a list of game results.
+
+    Returns
+    -------
+    Dict with the number of games, games won by each team (0 for no score), mean and
+    median ticks to score over games with a score, mean turnovers per game, and the
+    individual results.
+    """
+    scorer=np.array([r['scorer'] for r in results])
+    ticks=np.array([r['ticks'] for r in results])
+    turnovers=np.array([r['turnovers'] for r in results])
+    scored=scorer != 0
+    summary=dict(games=len(results))
+    summary['wins']={1:int((scorer == 1).sum()),-1:int((scorer == -1).sum()),0:int((~scored).sum())}
+    summary['mean_ticks_to_score']=float(ticks[scored].mean()) if scored.any() else None
+    summary['median_ticks_to_score']=float(np.median(ticks[scored])) if scored.any() else None
+    summary['mean_turnovers']=float(turnovers.mean()) if len(results) else None
+    summary['results']=results
+    return summary
+
+if __name__ == '__main__':
+    import sandbox
+    parser=argparse.ArgumentParser(description='Play a batch of sandbox games.')
+    parser.add_argument('ngames',type=int)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--workers',type=int,default=None)
+    args=parser.parse_args()
+    summary=run_batch(sandbox.lineup,args.ngames,seed=args.seed,max_workers=args.workers)
+    for key in ('games','wins','mean_ticks_to_score','median_ticks_to_score','mean_turnovers'):
+        print(key,summary[key])
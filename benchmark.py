@@ -0,0 +1,205 @@
+"""
+Scaling benchmarks for the simulation engine.
+
+Each case plays a few games of a generated lineup, mixing the Runner, Bruiser, Catcher,
+Thrower and Defender positions, for one roster size, field size and time step. It
+reports ticks per second, peak memory and the per phase breakdown of tick time (see
+timing). Every case is run in a fresh process, so its peak memory is its own.
+
+Results are saved as JSON and can be compared with an earlier run to catch
+performance regressions.
+
+Usage: python benchmark.py [--players N ...] [--fields XxY ...] [--dt DT ...]
+                           [--games N] [--out FILE] [--compare OLD_FILE]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import numpy as np
+import positions
+import timing
+import tools
+
+# Position classes in the generated lineups, handed out in turn within each team
+lineup_positions=(positions.Runner,positions.Bruiser,positions.Catcher,positions.Thrower,
+                  positions.Defender)
+
+# Default sweep
+default_players=(8,16,32,64,128,200)
+default_fields=((100,50),(200,100))
+default_dts=(0.1,0.05)
+
+def make_lineup(nplayers,xsize=100,ysize=50,dt=0.1,game_length=50.,seed=0):
+    """
+    Layout with nplayers players split over two teams, placed at random in their own half.
+
+    Parameters
+    ----------
+    nplayers : number of players, the home team gets the odd one out
+    xsize, ysize : field size
+    dt : time step
+    game_length : game length in seconds
+    seed : seed for the placement and for the game
+    """
+    l=tools.Layout(xsize,ysize,game_length,dt,seed=seed)
+    rng=np.random.default_rng(seed)
+    for i in range(nplayers):
+        team=1 if i % 2 == 0 else -1
+        jersey=i//2+1
+        position=lineup_positions[(jersey-1) % len(lineup_positions)]
+        x=rng.uniform(0.05,0.45)*xsize
+        if team == -1:
+            x=xsize-x
+        y=rng.uniform(0.05,0.95)*ysize
+        l.add_player(position(l,x,y,jersey,team))
+    return l
+
+def run_case(nplayers,xsize=100,ysize=50,dt=0.1,games=3,seed=0):
+    """
+    Play games games of one benchmark case in this process.
+
+    Returns
+    -------
+    Dict with the case parameters, ticks played, wall time, ticks per second, peak
+    resident memory of the process in MB and the per phase breakdown, summed over games.
+    """
+    ticks=0
+    seconds=0.
+    phases=dict((phase,0.) for phase in timing.phases)
+    for igame in range(games):
+        layout=make_lineup(nplayers,xsize,ysize,dt,seed=seed+igame)
+        with open(os.devnull,'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                start=time.perf_counter()
+                result=layout.run_game(display=False,replay_dir=None,profile=True)
+                seconds += time.perf_counter()-start
+        ticks += result['ticks']
+        for phase, stats in result['profile']['phases'].items():
+            phases[phase] += stats['total']
+    case=dict(players=nplayers,xsize=xsize,ysize=ysize,dt=dt,games=games,seed=seed)
+    case['ticks']=ticks
+    case['seconds']=seconds
+    case['ticks_per_second']=ticks/seconds if seconds > 0 else 0.
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    case['peak_rss_mb']=maxrss/(1024.**2 if sys.platform == 'darwin' else 1024.)
+    total=sum(phases.values())
+    case['phases']=dict((phase,dict(seconds=t,share=t/total if total > 0 else 0.))
+                        for phase, t in phases.items())
+    return case
+
+def run_suite(players=default_players,fields=default_fields,dts=default_dts,games=3,seed=0,
+              verbose=True):
+    """
+    Run every combination of roster size, field size and time step, each in a fresh
+    process.
+
+    Returns
+    -------
+    Dict with some details of the machine ('meta') and the results of each case ('cases').
+    """
+    context=multiprocessing.get_context('spawn')
+    cases=list()
+    for (xsize, ysize) in fields:
+        for dt in dts:
+            for nplayers in players:
+                with context.Pool(1) as pool:
+                    case=pool.apply(run_case,(nplayers,xsize,ysize,dt,games,seed))
+                if verbose:
+                    print(format_case(case))
+                cases.append(case)
+    return dict(meta=metadata(),cases=cases)
+
+def metadata():
+    " Details of the machine and software the benchmark ran on "
+    return dict(date=datetime.datetime.now().isoformat(),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                platform=platform.platform(),
+                processor=platform.processor())
+
+def case_key(case):
+    " Parameters identifying a case, for matching cases between runs "
+    return (case['players'],case['xsize'],case['ysize'],case['dt'])
+
+def format_case(case):
+    """
+    One line summary of a case, with the three most expensive phases.
+    """
+    top=sorted(case['phases'].items(),key=lambda item: -item[1]['share'])[:3]
+    return "%4d players %4gx%-4g dt %-5g %8.1f ticks/s %7.1f MB  %s" % (
+        case['players'],case['xsize'],case['ysize'],case['dt'],case['ticks_per_second'],
+        case['peak_rss_mb'],' '.join('%s %.0f%%' % (phase,100*s['share']) for phase, s in top))
+
+def save(results,path):
+    """
+    Write benchmark results as JSON.
+    """
+    with open(path,'w') as f:
+        json.dump(results,f,indent=1)
+
+def load(path):
+    """
+    Read benchmark results written by save.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def compare(old,new,tolerance=0.1):
+    """
+    Compare two benchmark runs case by case.
+
+    Parameters
+    ----------
+    old, new : results of run_suite (or load)
+    tolerance : relative drop in ticks per second counted as a regression
+
+    Returns
+    -------
+    List of (case key, old ticks/s, new ticks/s, relative change, regressed) for the
+    cases in both runs.
+    """
+    old_cases=dict((case_key(case),case) for case in old['cases'])
+    changes=list()
+    for case in new['cases']:
+        key=case_key(case)
+        if key not in old_cases:
+            continue
+        before=old_cases[key]['ticks_per_second']
+        after=case['ticks_per_second']
+        change=(after-before)/before if before > 0 else 0.
+        changes.append((key,before,after,change,change < -tolerance))
+    return changes
+
+def parse_field(text):
+    " Field size given as XxY "
+    xsize, ysize = text.lower().split('x')
+    return (float(xsize),float(ysize))
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Benchmark the engine over roster sizes, fields and time steps.')
+    parser.add_argument('--players',type=int,nargs='+',default=default_players)
+    parser.add_argument('--fields',type=parse_field,nargs='+',default=default_fields)
+    parser.add_argument('--dt',type=float,nargs='+',default=default_dts)
+    parser.add_argument('--games',type=int,default=3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--out',default='benchmark.json')
+    parser.add_argument('--compare',default=None,help='earlier results to check for regressions')
+    parser.add_argument('--tolerance',type=float,default=0.1)
+    args=parser.parse_args()
+    results=run_suite(args.players,args.fields,args.dt,args.games,args.seed)
+    save(results,args.out)
+    if args.compare is not None:
+        changes=compare(load(args.compare),results,args.tolerance)
+        for key, before, after, change, regressed in changes:
+            print("%4d players %4gx%-4g dt %-5g %8.1f -> %8.1f ticks/s %+6.1f%%%s" % (
+                key+(before,after,100*change,'  REGRESSION' if regressed else '')))
+        if any(change[-1] for change in changes):
+            sys.exit(1)
@@ -1,57 +1,246 @@
 """
 Helper objects that get updated periodically.
+
+A Layout keeps its helpers in a HelperGraph, which only updates a helper when it is
+looked up, at most once per tick, after the helpers it depends on.
 """
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
+
+# Weights of the kernels making up the relative hazard for receivers. See
+# Maps.rec_hazard_relative.
+rec_relative_weights=(0.01,0.0001,1,1)
+
+# Tolerance on game time, so rounding in time += dt doesn't put off a scheduled update
+time_eps=1e-9
+
+class HelperGraph(dict):
+    """
+    The Layout's helpers, by name, brought up to date on demand.
+
+    Looking a helper up updates it first, unless it has already been updated this tick or
+    isn't due yet (see Helper.update_freq). The helpers it depends on, which must not
+    depend on it in turn, are brought up to date before it. So a helper nothing reads in a
+    tick costs nothing.
+
+    Updates hold a lock, so objectives evaluated on several threads (see
+    Layout.run_objectives) all see a helper once it is fully updated.
+    """
+    def __init__(self,layout):
+        dict.__init__(self)
+        self.layout=layout
+        self.lock=threading.RLock()
+
+    def __getitem__(self,name):
+        h=dict.__getitem__(self,name)
+        if h.tick != self.layout.istep:
+            with self.lock:
+                if h.tick != self.layout.istep:
+                    self.refresh(h)
+        return h
+
+    def refresh(self,h):
+        " Update a helper and its dependencies for this tick, if due "
+        layout=self.layout
+        if h.update_freq is None or h.next_update <= layout.time + time_eps:
+            for name in h.depends:
+                self[name]
+            prof=layout.profiler
+            start=prof.clock()
+            h.update()
+            # The profiler isn't thread safe, on the worker threads this is left as part
+            # of the objectives phase
+            if not layout.threaded:
+                prof.charge('helpers',start)
+            if h.update_freq is not None:
+                h.next_update=layout.time + 1./h.update_freq
+        # Only marked once done, other threads wait on the lock until then
+        h.tick=layout.istep
+
+    def wake(self,events=None):
+        """
+        Make every helper due again, e.g. as an event listener when the ball changes hands.
+        """
+        for h in self.values():
+            h.next_update=self.layout.time
 
 class Helper(object):
     """
     Helper base class.
     """
+    # Names of the helpers this one reads in update
+    depends=()
+
     def __init__(self,layout):
-        self.update_freq=1
+        # Updates per second, None to update every tick it is used.
+        self.update_freq=None
+        self.next_update=0.
+        # Tick of the last update, see HelperGraph
+        self.tick=-1
         self.layout=layout
 
     def update(self):
         pass
 
+class Roster(Helper):
+    """
+    Snapshot of who has the ball and who is on either side of them, shared by the
+    carrier-centric helpers.
+
+    bc is the ball carrier, None if no one has the ball. att_rows and def_rows are the
+    store rows of the carrier's team (carrier included) and of their opponents.
+    """
+    def __init__(self,layout):
+        Helper.__init__(self,layout)
+        self.bc=None
+        self.att_rows=np.zeros(0,dtype=np.int64)
+        self.def_rows=np.zeros(0,dtype=np.int64)
+
+    def update(self):
+        if self.layout.ball.carrier == 0:
+            self.bc=None
+            self.att_rows=np.zeros(0,dtype=np.int64)
+            self.def_rows=np.zeros(0,dtype=np.int64)
+            return
+        s=self.layout.store
+        self.bc=self.layout.players[self.layout.ball.carrier]
+        self.att_rows=np.flatnonzero(s.team == self.bc.team)
+        self.def_rows=np.flatnonzero(s.team != self.bc.team)
+
 class BallCarrierPBeqs(Helper):
     """
     Computes equations for perpendicular bisectors of ball carrier and opponents.
 
     These equations are used by ball runners and defenders to decide where to go.
+
+    Bisectors of goalward opponents are stored as arrays, one entry per opponent:
+    pid, slope, intercept and vertical. Lines are y = slope*x + intercept, except where
+    vertical is set, in which case they are x = intercept.
+
+    Also stores the 'strike point' of each of those opponents: where they would meet
+    the carrier if the carrier holds their current velocity and the opponent runs
+    straight there at top speed. strike_x and strike_y are NaN for opponents that
+    can't catch the carrier, and strike_t is the time to the strike.
     """
+    depends=('roster',)
+
     def __init__(self,layout):
         Helper.__init__(self,layout)
+        self.reset()
         
+    def reset(self):
+        " Clear the stored bisectors, forcing a full recompute "
+        empty=np.zeros(0)
+        self.pid=np.zeros(0,dtype=np.int64)
+        self.slope=empty
+        self.intercept=empty
+        self.vertical=np.zeros(0,dtype=bool)
+        self.strike_x=empty
+        self.strike_y=empty
+        self.strike_t=empty
+        # Bisector of every player with the carrier, by row, and the positions they were
+        # computed from.
+        self.bc_pid=0
+        self.bc_xy=None
+        self.last_x=empty
+        self.last_y=empty
+        self.all_slope=empty
+        self.all_intercept=empty
+        self.all_vertical=np.zeros(0,dtype=bool)
+
     def update(self):
         """
         Find equations of the p.b. of all goalward opponents
         """
-        if self.layout.ball.carrier == 0:
-            self.pb_eqs=list()
+        roster=self.layout.helpers['roster']
+        if roster.bc is None:
+            self.reset()
             return
-    
-        self.pb_eqs=list()
-        bc=self.layout.players[self.layout.ball.carrier]
-        for p in self.layout.players.values():
-            if bc.team != p.team:
-                if bc.dist_to_goal() > p.dist_to_their_goal():
-                    # Maths!
-                    Px,Py = (bc.x+p.x)/2. , (bc.y+p.y)/2.
-                    if bc.y == p.y:
-                        # m would be infinite, describe eq differently
-                        # and denote by eq[3]=-1
-                        self.pb_eqs.append((p.pid,Px,0,-1))
-                    else:
-                        m=-1./( (bc.y-p.y)/(bc.x-p.x))
-                        #if p.x > self.x : m *= -1
-                        b = Py - m*Px
-                        self.pb_eqs.append((p.pid,m,b,0))
+
+        s=self.layout.store
+        bc=roster.bc
+        if len(self.last_x) != s.n:
+            self.reset()
+            self.last_x=np.full(s.n,np.nan)
+            self.last_y=np.full(s.n,np.nan)
+            self.all_slope=np.zeros(s.n)
+            self.all_intercept=np.zeros(s.n)
+            self.all_vertical=np.zeros(s.n,dtype=bool)
+        # Bisectors only change if the carrier or the opponent has moved
+        if self.bc_pid != bc.pid or self.bc_xy != (bc.x,bc.y):
+            dirty=np.ones(s.n,dtype=bool)
+        else:
+            dirty=(s.x != self.last_x) | (s.y != self.last_y)
+        self.bc_pid=bc.pid
+        self.bc_xy=(bc.x,bc.y)
+        self.last_x[dirty]=s.x[dirty]
+        self.last_y[dirty]=s.y[dirty]
+        self.compute_bisectors(np.flatnonzero(dirty),bc)
+
+        # Opponents closer to the goal than the carrier
+        rows=roster.def_rows[(s.x[roster.def_rows]-bc.x)*bc.team > 0]
+        self.pid=rows+1
+        self.slope=self.all_slope[rows]
+        self.intercept=self.all_intercept[rows]
+        self.vertical=self.all_vertical[rows]
         # Now find projected 'strike point' of BC with opponents
-        # TODO
+        self.strike_x, self.strike_y, self.strike_t = self.compute_strikes(rows,bc)
+
+    def compute_bisectors(self,rows,bc):
+        " Maths! Bisectors of the carrier and the given rows "
+        s=self.layout.store
+        x=s.x[rows]
+        y=s.y[rows]
+        Px, Py = (bc.x+x)/2., (bc.y+y)/2.
+        # Where y co-ords are equal m would be infinite, describe eq differently
+        vertical = y == bc.y
+        with np.errstate(divide='ignore',invalid='ignore'):
+            m = -(bc.x-x)/(bc.y-y)
+        self.all_vertical[rows]=vertical
+        self.all_slope[rows]=np.where(vertical,0.,m)
+        self.all_intercept[rows]=np.where(vertical,Px,Py - m*Px)
+
+    def compute_strikes(self,rows,bc):
+        """
+        Strike points of the given rows. Solves |B + V*t - P| = s*t for the earliest
+        t > 0, where B and V are the carrier position and velocity, P the opponent
+        position and s their top speed.
+        """
+        s=self.layout.store
+        vx, vy = bc.current_speed*np.cos(bc.angle), bc.current_speed*np.sin(bc.angle)
+        wx = bc.x - s.x[rows]
+        wy = bc.y - s.y[rows]
+        a = vx**2 + vy**2 - s.top_speed[rows]**2
+        b = 2.*(wx*vx + wy*vy)
+        c = wx**2 + wy**2
+        with np.errstate(divide='ignore',invalid='ignore'):
+            root = np.sqrt(b**2 - 4.*a*c)
+            t1 = (-b - root)/(2.*a)
+            t2 = (-b + root)/(2.*a)
+            # Equal speeds, the quadratic is linear
+            t_lin = -c/b
+        t1 = np.where(t1 > 0,t1,np.inf)
+        t2 = np.where(t2 > 0,t2,np.inf)
+        t = np.where(a == 0,np.where(t_lin > 0,t_lin,np.inf),np.minimum(t1,t2))
+        t[np.isnan(t)] = np.inf
+        # A strike right now is where the carrier is
+        t[c == 0] = 0.
+        hit = np.isfinite(t)
+        sx = np.where(hit,bc.x + vx*t,np.nan)
+        sy = np.where(hit,bc.y + vy*t,np.nan)
+        return (sx,sy,t)
+
+    def strike_point(self,pid):
+        """
+        Returns the (x,y) strike point of the given opponent, or None if they have none.
+        """
+        i=np.flatnonzero(self.pid == pid)
+        if len(i) == 0 or not np.isfinite(self.strike_x[i[0]]):
+            return None
+        return (self.strike_x[i[0]],self.strike_y[i[0]])
 
 class Maps(Helper):
+    depends=('roster',)
 
     def __init__(self,layout):
         Helper.__init__(self,layout)    
@@ -66,63 +255,83 @@ class Maps(Helper):
         # these as well as tuneable parameters to those kernels. Implement something then
         # worry later about fine tuning the details.
 
+        # Nothing to go on until someone first has the ball
+        self.defenders=list()
+        self.receivers=list()
+
     def update(self):
 
-        if self.layout.ball.carrier == 0:
+        roster=self.layout.helpers['roster']
+        if roster.bc is None:
             return
 
-        self.bc=self.layout.players[self.layout.ball.carrier]
+        self.bc=roster.bc
+        players=self.layout.players
 
         # make list of defenders
-        self.defenders=list()
-        for p in self.layout.players.values():
-            if p.team != self.bc.team:
-                self.defenders.append(p)
+        self.defenders=[players[row+1] for row in roster.def_rows]
 
         # make list of recievers
         # For now, all bc friends are receivers.
-        self.receivers=list()
-        for p in self.layout.players.values():
-            if p.team == self.bc.team:
-                self.receivers.append(p)        
+        self.receivers=[players[row+1] for row in roster.att_rows]
+
+        # Cache co-ordinates as arrays for the kernels
+        s=self.layout.store
+        self.bc_x=self.bc.x
+        self.bc_y=self.bc.y
+        rows=roster.def_rows
+        self.def_pids=rows+1
+        self.def_x=s.x[rows]
+        self.def_y=s.y[rows]
+        rows=roster.att_rows
+        self.rec_pids=rows+1
+        self.rec_x=s.x[rows]
+        self.rec_y=s.y[rows]
         
     # Here are some kernels.
     # parabolic with weight for now
     # Ensure the sign is such that "small is good spot for receiver to be"
     # in other words can interpret as a "hazard map for receiver"
+    #
+    # All kernels accept x and y either as scalars or as arrays of candidate points.
     def end_zone_kern(self,p,x,y,w=1):
         return w*p.dist_to_goal(x=x)**2
 
     def pass_dist_kern(self,x,y,w=1):
-        dsq=(self.bc.x-x)**2 + (self.bc.y-y)**2
+        dsq=(self.bc_x-x)**2 + (self.bc_y-y)**2
         return w*dsq
+
+    def min_dist(self,px,py,pids,thisPlayer,x,y):
+        """
+        Distance from each (x,y) to the nearest of the points (px,py), excluding thisPlayer.
+        Zero if there are no points.
+        """
+        keep=pids != thisPlayer.pid
+        x=np.asarray(x)
+        y=np.asarray(y)
+        if not keep.any():
+            return np.zeros(np.broadcast(x,y).shape)
+        dsq=(x[...,np.newaxis]-px[keep])**2 + (y[...,np.newaxis]-py[keep])**2
+        return np.sqrt(dsq.min(axis=-1))
     
     def def_dist_kern(self,thisPlayer,x,y,w=1):
         " Uses minimimum distance only, no weighting for number of defenders "
-        # Find all the distances
-        dlist=list()
-        for p in self.defenders:
-            if p.pid == thisPlayer.pid:
-                continue
-            dlist.append(np.sqrt((x-p.x)**2 + (y-p.y)**2))
-        return -min(dlist)
+        return -w*self.min_dist(self.def_x,self.def_y,self.def_pids,thisPlayer,x,y)
 
     def rec_dist_kern(self,thisPlayer,x,y,w=1):
-        # Find all the distances
-        rlist=list()
-        for p in self.receivers:
-            if p.pid == thisPlayer.pid:
-                continue
-            rlist.append(np.sqrt((x-p.x)**2 + (y-p.y)**2))
-        return -min(rlist)
+        " Minimum distance to other receivers "
+        return -w*self.min_dist(self.rec_x,self.rec_y,self.rec_pids,thisPlayer,x,y)
 
-    # Pull all the kernels together including a weight vector
-    def rec_hazard_relative(self,xy,p,w=(0.01,0.0001,1,1)):
+    # Pull all the kernels together including a weight vector.
+    # xy is either a single (x,y) point or an (N,2) array of candidate points, in which
+    # case an array of N hazards is returned.
+    def rec_hazard_relative(self,xy,p,w=rec_relative_weights):
         """
         Hazard function for recievers when determining where to move.
         """
-        x=xy[0]
-        y=xy[1]
+        xy=np.asarray(xy)
+        x=xy[...,0]
+        y=xy[...,1]
         return self.end_zone_kern(p,x,y,w[0]) + self.pass_dist_kern(x,y,w[1]) + self.def_dist_kern(p,x,y,w[2]) +\
             self.rec_dist_kern(p,x,y,w[3])
 
@@ -130,94 +339,152 @@ class Maps(Helper):
         """
         Hazard function for recievers for comparing different players.
         """
-        x=xy[0]
-        y=xy[1]
+        xy=np.asarray(xy)
+        x=xy[...,0]
+        y=xy[...,1]
         return self.end_zone_kern(p,x,y,w[0]) + self.pass_dist_kern(x,y,w[1]) + self.def_dist_kern(p,x,y,w[2])
     
     def throw_hazard_absolute(self,xy,p,w=(0.01,1)):
         """
         Hazard function for throwers to compare their location to rxs.
         """
-        x=xy[0]
-        y=xy[1]
+        xy=np.asarray(xy)
+        x=xy[...,0]
+        y=xy[...,1]
         return self.end_zone_kern(p,x,y,w[0]) + self.def_dist_kern(p,x,y,w[1])
 
+    def receiver_xy(self):
+        " (N,2) array of receiver positions, in the same order as self.receivers "
+        return np.column_stack((self.rec_x,self.rec_y))
+
 
-# This is the early, experimental and slow(!) approach.
 class HazardMaps(Helper):
     """
     Computes are stores hazard maps for use by catchers and possibly also
     runners, defenders and throwers to determine what parts of the pitch
     are open for attack.
 
-    Note that it is too inefficient to use these in practice, these are just
-    for debugging/development and may differ from real player implementations.
+    Maps are stored on an nx by ny grid over the pitch, indexed [ix,iy], and are
+    built with array operations so they are cheap enough to update every tick.
+
+    Parameters
+    ----------
+    nx, ny : grid size, defaults to the class values
+    dtype : storage type of the maps
     """
+    depends=('roster',)
     # Set class default grid spacing
     nx=100
     ny=50
-    def __init__(self,layout):
+    def __init__(self,layout,nx=None,ny=None,dtype=np.float32):
         Helper.__init__(self,layout)
-        # 
+        # Only receivers' coarse search uses the maps, which is refined exactly anyway
+        self.update_freq=5.
+        if nx is not None:
+            self.nx=nx
+        if ny is not None:
+            self.ny=ny
+        self.dtype=dtype
+        self.maps=dict()
+        # Grid point co-ordinates. Sparse, so they broadcast to (nx,ny) when combined.
+        self.dx=self.layout.xsize/self.nx
+        self.dy=self.layout.ysize/self.ny
+        self.xgrid=(np.arange(self.nx)*self.dx).astype(dtype)
+        self.ygrid=(np.arange(self.ny)*self.dy).astype(dtype)
+        self.X, self.Y = np.meshgrid(self.xgrid,self.ygrid,indexing='ij',sparse=True)
+
     def update(self):
         # Ultimately, computing and stroing on a grid may not be the best solution,
         # continous functions that can be minimised may be better. For now, maps
         # make visualisation for debugging easy.
         self.maps=dict()
-        if self.layout.ball.carrier == 0:
+        bc=self.layout.helpers['roster'].bc
+        if bc is None:
             return
-        bc=self.layout.players[self.layout.ball.carrier]
         self.maps['EZ_dist'] = self.EZ_dist_compute(bc)
         self.maps['pass_dist'] = self.pass_dist_compute(bc)
         self.maps['def_dist'] = self.def_dist_compute(bc)
-        best=self.maps['EZ_dist']**2+0.5*self.maps['pass_dist']**2 - self.maps['def_dist']**2
-        plt.contour(range(self.nx),range(self.ny),best.transpose(),50)
+        self.maps['best']=self.maps['EZ_dist']**2+0.5*self.maps['pass_dist']**2 - self.maps['def_dist']**2
+        # Hazard field shared by all receivers on the carrier's team, the grid equivalent of
+        # Maps.rec_hazard_relative without the term for other receivers. That term depends on
+        # the receiver, so store the distance to the nearest and second nearest receivers, and
+        # which is nearest, to pick from in receiver_field.
+        w=rec_relative_weights
+        self.maps['rec_field']=w[0]*self.maps['EZ_dist']**2 + w[1]*self.maps['pass_dist']**2\
+            - w[2]*self.maps['def_dist']
+        self.rec_nearest, self.maps['rec_dist1'], self.maps['rec_dist2'] = self.rec_dist_compute(bc)
+
+    def plot(self,name='best'):
+        """
+        Debugging aid, contour plot of a map with the players overlaid.
+        """
+        import matplotlib.pyplot as plt
+        plt.contour(self.xgrid,self.ygrid,self.maps[name].transpose(),50)
         for p in self.layout.players.values():
             plt.plot(p.x,p.y,'bo')
         plt.show()
 
     def EZ_dist_compute(self,bc):
         " Distance to end zone map "
-        dx=float(self.layout.xsize)/self.nx
-        dy=float(self.layout.ysize)/self.ny
-        dmap=np.empty((self.nx,self.ny))
-        for ix in range(self.nx):
-            x=ix*dx
-            for iy in range(self.ny):
-                y=iy*dy
-                dmap[ix,iy] = bc.dist_to_goal(x=x)
+        dmap=np.empty((self.nx,self.ny),dtype=self.dtype)
+        dmap[...] = bc.dist_to_goal(x=self.X)
         return dmap
     
     def pass_dist_compute(self,bc):
         " Distance of a potential pass "
-        dx=float(self.layout.xsize)/self.nx
-        dy=float(self.layout.ysize)/self.ny
-        dmap=np.empty((self.nx,self.ny))
-        for ix in range(self.nx):
-            x=ix*dx
-            for iy in range(self.ny):
-                y=iy*dy
-                dmap[ix,iy] = np.sqrt((bc.x-x)**2 + (bc.y-y)**2)
-        return dmap
+        return np.sqrt((self.X-self.dtype(bc.x))**2 + (self.Y-self.dtype(bc.y))**2)
 
     def def_dist_compute(self,bc):
         " Distance to nearest defender "
-        dx=float(self.layout.xsize)/self.nx
-        dy=float(self.layout.ysize)/self.ny
-        dmap=np.empty((self.nx,self.ny))
-        # make list of defenders
-        defenders=list()
-        for p in self.layout.players.values():
-            if p.team != bc.team:
-                defenders.append(p)
-                #print(p.x,p.y)
-        for ix in range(self.nx):
-            x=ix*dx
-            for iy in range(self.ny):
-                y=iy*dy
-                # Find all the distances
-                dlist=list()
-                for p in defenders:
-                    dlist.append(np.sqrt((x-p.x)**2 + (y-p.y)**2))
-                dmap[ix,iy] = min(dlist)
-        return dmap    
+        s=self.layout.store
+        rows=self.layout.helpers['roster'].def_rows
+        return self.min_dist_compute(s.x[rows],s.y[rows])
+
+    def rec_dist_compute(self,bc):
+        """
+        Distance to the nearest and second nearest receivers (the carrier's team).
+
+        Returns
+        -------
+        Tuple of (pid of nearest receiver, nearest distance, second nearest distance) maps.
+        """
+        s=self.layout.store
+        rows=self.layout.helpers['roster'].att_rows
+        far=self.layout.xsize**2+self.layout.ysize**2
+        dsq1=np.full((self.nx,self.ny),far,dtype=self.dtype)
+        dsq2=np.full((self.nx,self.ny),far,dtype=self.dtype)
+        nearest=np.zeros((self.nx,self.ny),dtype=np.int32)
+        for pid, x, y in zip(rows+1,s.x[rows].astype(self.dtype),s.y[rows].astype(self.dtype)):
+            dsq=(self.X-x)**2 + (self.Y-y)**2
+            closer=dsq < dsq1
+            dsq2=np.where(closer,dsq1,np.minimum(dsq2,dsq))
+            dsq1=np.where(closer,dsq,dsq1)
+            nearest[closer]=pid
+        return (nearest,np.sqrt(dsq1),np.sqrt(dsq2))
+
+    def receiver_field(self,p):
+        """
+        Relative hazard for receiver p over the grid.
+        """
+        other=np.where(self.rec_nearest == p.pid,self.maps['rec_dist2'],self.maps['rec_dist1'])
+        return self.maps['rec_field'] - rec_relative_weights[3]*other
+
+    def receiver_best(self,p):
+        """
+        Grid point with the lowest relative hazard for receiver p.
+        """
+        ix, iy = np.unravel_index(np.argmin(self.receiver_field(p)),(self.nx,self.ny))
+        return np.array((self.xgrid[ix],self.ygrid[iy]),dtype=float)
+
+    def min_dist_compute(self,px,py):
+        """
+        Distance from each grid point to the nearest of the points (px,py).
+
+        With no points, the distance is the length of the pitch diagonal.
+        """
+        # Keep a running minimum of squared distance, one point at a time, so memory
+        # doesn't grow with the number of points.
+        dsq=np.full((self.nx,self.ny),self.layout.xsize**2+self.layout.ysize**2,dtype=self.dtype)
+        for x, y in zip(px.astype(self.dtype),py.astype(self.dtype)):
+            np.minimum(dsq,(self.X-x)**2 + (self.Y-y)**2,out=dsq)
+        return np.sqrt(dsq)
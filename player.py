@@ -1,13 +1,22 @@
 import numpy as np
 import math
 import utils
-import scipy.optimize as opt
+import store
 from const import *
-import matplotlib.pyplot as plt
-import pylab
-import pdb
 
-fmin_xtol=0.5
+# Points per side of the patch scored when refining find_space.
+refine_points=5
+
+def update_rate(hz):
+    """
+    Decorator declaring how often an objective method needs to run, in updates per second.
+    In between, the Layout holds the objective it last set (see Layout.run_objectives).
+    Objective methods without a rate run every tick.
+    """
+    def decorate(func):
+        func.update_rate=hz
+        return func
+    return decorate
 
 class Player(object):
     """
@@ -20,8 +29,27 @@ class Player(object):
     Units:
     
     """
+    __slots__=('layout','_store','_row','pid','strength','throw_power','jersey','cdrag',
+               'want_to_block','want_to_catch','ai_config','objective','scheduled')
+    # Kinematic state lives in a store.PlayerStore. Until the player is registered to a layout
+    # it has a private single row store, see Layout.add_player.
+    x=store.StateField('x')
+    y=store.StateField('y')
+    angle=store.StateField('angle')
+    current_speed=store.StateField('current_speed')
+    x_objective=store.StateField('x_objective')
+    y_objective=store.StateField('y_objective')
+    state=store.StateField('state')
+    prone_counter=store.StateField('prone_counter')
+    size=store.StateField('size')
+    top_speed=store.StateField('top_speed')
+    acc=store.StateField('acc')
+    team=store.StateField('team')
+
     def __init__(self,layout,size,x,y,top_speed,acc,strength,throw_power,jersey,team,angle_of_motion=0):
         self.layout=layout
+        self._store=store.PlayerStore()
+        self._row=self._store.add()
         self.size=size
         self.pid=0 # Actual PIDs get set when player is registered to a layout.
         self.x=float(x)
@@ -33,13 +61,14 @@ class Player(object):
         self.jersey=jersey
         self.team=team
         self.angle=angle_of_motion
-        self.triggered=True
         # Drag model?
         self.cdrag = self.acc/self.top_speed**2
         #
         self.current_speed=0.
         self.x_objective=0.
         self.y_objective=0.
+        # Objective method last run by the Layout's scheduler
+        self.scheduled=None
         ### Define how to resolve collisions between opposing team players
         # A player not wanting to block will instead try to evade, for instance
         # to get around a blocker to make a tackle, or get clear to make a lead
@@ -52,14 +81,13 @@ class Player(object):
         # Set to standing
         self.state=1
         # Allocate prone counter
-        self.prone=-1
+        self.prone_counter=-1
         @property
         def objective(self):
             self._objective()
         @objective.setter
         def objective(self,new_objective):
             self._objective=new_objective
-            self.triggered=True
 
     def set_ai_config(self):
         " Defines postional play."
@@ -91,13 +119,14 @@ class Player(object):
         self.x_objective = self.layout.ball.x
         self.y_objective = self.layout.ball.y
 
+    @update_rate(5.)
     def run_to_goal(self):
         """
         Run towards offensive end zone, avoiding opponents.
         """
         # This could be replaced by angle to end zone corner?
         max_angle_to_run = 80.
-        angle_step=5
+        angle_step=1.
 
         # Set defaults in case there are no obstacles in our path.
         # NOTE: This is sub-optimal in the case that any defenders behind
@@ -113,48 +142,17 @@ class Player(object):
         if self.team == -1:
             ang_start += 180
             ang_end += 180      
-        
-        def distAlongAngle(ang,obj,full_return=False):
-            " Finds shortest dist along this angle"
-            # find eq of line from me at angle
-            m=math.tan(ang*deg2rad)
-            b=obj.y - m*obj.x
-            # Find shortest intersection distance
-            shortest_dist=-1
-            for eq in pb_eqs:
-                if eq[2] == -1:
-                    # Case where y co-ords are equal.
-                    dist=abs(obj.x-eq[1])
-                    yi=obj.y
-                    xi=eq[1]
-                else:
-                    # Find co-ords of intersection point
-                    xi=(b-eq[2])/(eq[1]-m)
-                    yi=m*xi+b
-                    # Checks for intersection being out of bounds
-                    if (yi > obj.layout.ysize):
-                        # Pull back intersection point to OOB position
-                        yi = obj.layout.ysize
-                        xi = (yi-b)/m
-                    elif (yi < 0):
-                        yi = 0
-                        xi = (yi-b)/m
-                    # Ensure intersection points are in the field
-                    xi = utils.bracket(0,xi,obj.layout.xsize)
-                    #dist=np.sqrt( (x-xi)**2 + (y-yi)**2)
-                    dist=xi-obj.x
-                if dist < shortest_dist or shortest_dist < 0.:
-                    shortest_dist=dist
-                    xs=xi
-                    ys=yi
-            if full_return:
-                return (shortest_dist,xs,ys)
-            return -shortest_dist
-
-        pb_eqs = self.layout.helpers['pb_eqs'].pb_eqs
-        if len(pb_eqs) != 0: 
-            best_angle = opt.fminbound(distAlongAngle,ang_start,ang_end,args=(self,))
-            dist, best_x, best_y = distAlongAngle(best_angle,self,full_return=True)
+
+        pb = self.layout.helpers['pb_eqs']
+        if len(pb.pid) != 0: 
+            # Sweep a fan of lanes and take the one that gets us furthest goalward,
+            # preferring the straightest of equally good lanes.
+            angles = np.arange(ang_start,ang_end+angle_step/2.,angle_step)
+            xs, ys = self.lane_ends(angles*deg2rad,pb.slope,pb.intercept,pb.vertical)
+            gain = (xs-self.x)*self.team
+            best = np.flatnonzero(gain >= gain.max()-1e-9)
+            ibest = best[np.argmin(np.abs(angles[best]-(ang_start+ang_end)/2.))]
+            best_x, best_y = xs[ibest], ys[ibest]
 
         self.x_objective = best_x
         self.y_objective = best_y
@@ -165,15 +163,55 @@ class Player(object):
         self.y_objective = min(self.y_objective,self.layout.ysize-buff)
         self.y_objective = max(self.y_objective,buff)
 
+    def lane_ends(self,angles,slope,intercept,vertical):
+        """
+        Finds where straight runs from our position first cross a perpendicular bisector
+        (i.e. where an opponent could get to first), or else leave the pitch.
+
+        Parameters
+        ----------
+        angles : array of run directions, in radians
+        slope, intercept : arrays of bisectors y = slope*x + intercept
+        vertical : boolean array flagging vertical bisectors, x = intercept
+
+        Returns
+        -------
+        Tuple of arrays (x,y) of the end point of each run.
+        """
+        dx = np.cos(angles)[:,np.newaxis]
+        dy = np.sin(angles)[:,np.newaxis]
+        # Lines as a*x + b*y = c
+        a = np.where(vertical,1.,-slope)
+        b = np.where(vertical,0.,1.)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            # Distance along each run to each line, only crossings ahead of us count
+            t = (intercept - a*self.x - b*self.y)/(a*dx + b*dy)
+            t[~(t > 0)] = np.inf
+            t_line = t.min(axis=1)
+            # Distance along each run to the sidelines and end lines
+            dx = dx[:,0]
+            dy = dy[:,0]
+            t_x = np.where(dx > 0,(self.layout.xsize-self.x)/dx,np.where(dx < 0,-self.x/dx,np.inf))
+            t_y = np.where(dy > 0,(self.layout.ysize-self.y)/dy,np.where(dy < 0,-self.y/dy,np.inf))
+        t_end = np.minimum(t_line,np.minimum(t_x,t_y))
+        # Ensure end points are in the field
+        xs = np.clip(self.x + t_end*dx,0,self.layout.xsize)
+        ys = np.clip(self.y + t_end*dy,0,self.layout.ysize)
+        return (xs,ys)
+
     def tackle_ball_carrier(self):
         """
         Run to ball carrier and try to tackle.
         """
         dill=self.layout.players[self.layout.ball.carrier]
+        strike=self.layout.helpers['pb_eqs'].strike_point(self.pid)
 
         if self.dist_to_other(dill) < self.size*1.5:
             self.x_objective = dill.x
             self.y_objective = dill.y
+        elif strike is not None:
+            # Head for where we can cut off the carrier
+            self.x_objective, self.y_objective = strike
         else:
             # Run to point D in front of ball carrier, where D is the distance
             # between self and the carrier.
@@ -216,66 +254,29 @@ class Player(object):
         # a threat to the carrier. We could try to block the one nearest the carrier, but
         # there might be one closer to us we could better block??
     
-    def find_space_entry(self):
-        """
-        Called when triggered.
-        """
-        self.triggered=False
-        # Ensure we run full minimiser
-        self.find_space_update_track=self.find_space_update_time*2.
-
+    @update_rate(2.)
     def find_space(self):
         """
         Get in a good position for recieving a pass
         """     
-        if self.triggered: self.find_space_entry()
-        
-        # Minimise to find best spot to head towards
-        bc=self.layout.players[self.layout.ball.carrier]
-
-        # Wrapper to hazard function
-        def haz_wrap(xy):
-            return self.layout.helpers['maps'].rec_hazard_relative(xy,self)
-
-        # We only run full minimizer every ??time??. In other cases, we start from previous stored state.
-        self.find_space_update_track += self.layout.dt
-        if self.find_space_update_track > self.find_space_update_time:
-            self.find_space_update_track=0.
-            # Try starting from 3 places:
-            # * Your position
-            # * bc positiong
-            # * goal end zone at your y
-            # 
-            # This help avoids getting trapped in local minima, ensuring we check for good short and
-            # long pass options as well as options near to us.
-
-            res_bc = opt.fmin(haz_wrap, np.array( (bc.x,bc.y) ), xtol=fmin_xtol, disp=False, full_output=True)
-            best_func = res_bc[1]
-            best_xy = res_bc[0]
-        
-            res_self = opt.fmin(haz_wrap, np.array( (self.x,self.y) ),xtol=fmin_xtol, disp=False, full_output=True)
-            if res_self[1] < best_func:
-                best_func = res_self[1]
-                best_xy = res_self[0]
-        
-            if self.team == 1:
-                ez_x = self.layout.xsize
-            else:
-                ez_x = 0
-            res_ez = opt.fmin(haz_wrap, np.array( (ez_x,self.y) ),xtol=fmin_xtol, disp=False, full_output=True)
-            if res_ez[1] < best_func:
-                best_func = res_ez[1]
-                best_xy = res_ez[0]
-        else:
-            # Run minimiser from previous stored solution
-            xy = self.find_space_best
-            res = opt.fmin(haz_wrap, np.array( (xy[0],xy[1]) ),xtol=fmin_xtol, disp=False, full_output=True)
-            best_xy = res[0]
-
-        self.find_space_best = best_xy
+        # Receivers share one coarse hazard grid, the best point on it is then refined.
+        xy = self.layout.helpers['hazard'].receiver_best(self)
+        best_xy = self.refine_space(xy)
         self.x_objective = best_xy[0]
         self.y_objective = best_xy[1]
-    
+
+    def refine_space(self,xy):
+        """
+        Polish a find_space solution by scoring a small patch of points around it, one
+        hazard grid cell either side, with the exact receiver hazard.
+        """
+        hazard=self.layout.helpers['hazard']
+        offsets=np.linspace(-1.,1.,refine_points)
+        xs=np.clip(xy[0] + offsets*hazard.dx,0,self.layout.xsize)
+        ys=np.clip(xy[1] + offsets*hazard.dy,0,self.layout.ysize)
+        pts=np.column_stack([a.ravel() for a in np.meshgrid(xs,ys)])
+        haz=self.layout.helpers['maps'].rec_hazard_relative(pts,self)
+        return pts[np.argmin(haz)]
 
     def run_or_pass(self):
         """
@@ -284,13 +285,19 @@ class Player(object):
         TODO: Should require the rx be more than just a bit better since passes are risky.
         """
 
-        my_hazard = self.layout.helpers['maps'].throw_hazard_absolute((self.x,self.y),self)
+        maps = self.layout.helpers['maps']
+        my_hazard = maps.throw_hazard_absolute((self.x,self.y),self)
 
-        rec_hazard=list()
-        for p in self.layout.helpers['maps'].receivers:
-            if p.pid == self.pid:
-                continue
-            rec_hazard.append(self.layout.helpers['maps'].rec_hazard_absolute((p.x,p.y),p))
+        # Score all the other receivers in one go
+        others = maps.rec_pids != self.pid
+        if not others.any():
+            # No one to pass to
+            self.run_to_goal()
+            return
+        # Judge each receiver where the pass would meet them
+        receivers = [p for p in maps.receivers if p.pid != self.pid]
+        targets = self.lead_receivers(maps.rec_pids[others]-1)
+        rec_hazard = maps.rec_hazard_absolute(targets,self)
 
         imin_rec = np.argmin(rec_hazard)
         print(self.pid,my_hazard,rec_hazard[imin_rec])
@@ -299,24 +306,42 @@ class Player(object):
             self.run_to_goal()
         else:
             # Pass to the rx in a better position
-            self.throw_pass(self.layout.helpers['maps'].receivers[imin_rec])
-        
-    def throw_pass(self,rec):
+            self.throw_pass(receivers[imin_rec],targets[imin_rec])
+
+    def lead_receivers(self,rows):
+        """
+        Where to throw to meet each of the receivers in store rows, if they keep running
+        as they are, see throws.ThrowTable.lead.
+
+        Returns
+        -------
+        (N,2) array of target points, kept on the pitch.
+        """
+        s=self.layout.store
+        vx=s.current_speed[rows]*np.cos(s.angle[rows])
+        vy=s.current_speed[rows]*np.sin(s.angle[rows])
+        tx, ty, _ = self.layout.ball.throws.lead(self.throw_power,self.x,self.y,
+                                                 s.x[rows],s.y[rows],vx,vy)
+        return np.column_stack((np.clip(tx,0,self.layout.xsize),np.clip(ty,0,self.layout.ysize)))
+
+    def throw_pass(self,rec,target=None):
         """
         Throw the ball to the specified receiver.
 
-        TODO: Very simplistic to throw to rx position. Instead this routine should evaluate
-        the time the pass might take and project rx position. For any given target location, there
-        is a locus in (angle,power) that will get us there, so this needs to be considered as well.
-        Also need to introduce a skill dependant accuracy and judgement.
+        TODO: For any given target location, there is a locus in (angle,power) that will get
+        us there, so this needs to be considered as well. Also need to introduce a skill
+        dependant accuracy and judgement.
         
         Parameters
         ----------
         rx : The reciever (object)
+        target : (x,y) to throw to, by default leading the receiver (see lead_receivers)
         """
-        # Just throw to rx position
-        elv = self.layout.ball.find_launch_angle(self.throw_power,rec.x,rec.y)
-        self.layout.ball.throw(elv,self.throw_power,rec.x,rec.y)
+        if target is None:
+            target = self.lead_receivers(np.array([rec._row]))[0]
+        tx, ty = float(target[0]), float(target[1])
+        elv = self.layout.ball.find_launch_angle(self.throw_power,tx,ty)
+        self.layout.ball.throw(elv,self.throw_power,tx,ty)
         # Hack to stop us catching our own pass as we throw it!
         self.want_to_catch = False
 
@@ -332,19 +357,19 @@ class Player(object):
         self.y_objective = self.layout.ball.yland
         self.want_to_catch=True
 
+    @update_rate(2.)
     def coverage(self):
         """
         Cover potential recievers or the ball carrier. Defensive.
         """
-        dill=None
-        for p in self.layout.helpers['maps'].receivers:
-            haz = self.layout.helpers['maps'].throw_hazard_absolute((p.x,p.y),self)
-            if dill == None:
-                best_haz=haz
-                dill=p
-            else if haz < best_haz:
-                best_haz=haz
-                dill=p
+        maps=self.layout.helpers['maps']
+        if len(maps.receivers) == 0:
+            # No one has had the ball yet, hold position
+            self.x_objective=self.x
+            self.y_objective=self.y
+            return
+        haz = maps.throw_hazard_absolute(maps.receiver_xy(),self)
+        dill = maps.receivers[np.argmin(haz)]
         if self.dist_to_goal(x=dill.x) > self.forward_limit:
             # TODO: Don't go further than the forward limit
             self.x_objective=dill.x
@@ -353,10 +378,15 @@ class Player(object):
             self.x_objective=dill.x
             self.y_objective=dill.y
 
-    def move(self):
+    def move(self,acc_angle=None):
         """
         Move method for each tick update. For stated objective, determines best angle to run at
         given current velocity.
+
+        Parameters
+        ----------
+        acc_angle : angle to accelerate at, in radians. If None, it is found by minimising
+                    eval_move (the reference steering mode).
         """
         # We are ignoring \delta_t by calling it unity, so V and A need to be in appropriate
         # units to reflect that.
@@ -370,27 +400,8 @@ class Player(object):
         if np.sqrt((self.y_objective-self.y)**2 + (self.x_objective-self.x)**2) == 0.:
             return
 
-        # Use Brent method to find best angle to accelerate at to reach objective.
-        pi = 4.*math.atan(1.)
-        # Bracket angle to be at least in hemisphere of objective
-        try:
-            obj_angle = np.tan((self.y_objective-self.y)/(self.x_objective-self.x))
-            if not np.isfinite(obj_angle):
-                print("non finite",self.y_objective,self.y,self.x_objective,self.x)
-            if self.x_objective-self.x < 0:
-                obj_angle += pi
-        except:
-            # div by zero?
-            print("exc in move",self.y_objective,self.y,self.x_objective,self.x)
-            obj_angle = 0.
-
-        #try:
-        #    best_acc = opt.brent(lambda angle : self.eval_move(angle), brack=(-pi,pi))
-        #except:
-        #    best_acc = obj_angle
-        #acc_angle = best_acc
-
-        acc_angle = opt.fmin(lambda angle : self.eval_move(angle),obj_angle,xtol=pi/180.,disp=False)
+        if acc_angle is None:
+            acc_angle = self.min_acc_angle()
 
         self.x, self.y, self.angle, self.current_speed = self.project_move(acc_angle)
  
@@ -418,6 +429,35 @@ class Player(object):
         if self.pid == self.layout.ball.carrier:
             print(self.pid,self.team,self.objective,self.layout.ball.carrier)
 
+    def min_acc_angle(self):
+        """
+        Reference steering. Numerically minimises eval_move to find the angle to
+        accelerate at. See steering.best_acc_angles for the closed form equivalent.
+        """
+        # Use Brent method to find best angle to accelerate at to reach objective.
+        pi = 4.*math.atan(1.)
+        # Bracket angle to be at least in hemisphere of objective
+        try:
+            obj_angle = np.tan((self.y_objective-self.y)/(self.x_objective-self.x))
+            if not np.isfinite(obj_angle):
+                print("non finite",self.y_objective,self.y,self.x_objective,self.x)
+            if self.x_objective-self.x < 0:
+                obj_angle += pi
+        except:
+            # div by zero?
+            print("exc in move",self.y_objective,self.y,self.x_objective,self.x)
+            obj_angle = 0.
+
+        #try:
+        #    best_acc = opt.brent(lambda angle : self.eval_move(angle), brack=(-pi,pi))
+        #except:
+        #    best_acc = obj_angle
+        #acc_angle = best_acc
+
+        # Only the reference steering uses scipy, load it on first use
+        import scipy.optimize as opt
+        return opt.fmin(lambda angle : self.eval_move(angle[0]),obj_angle,xtol=pi/180.,disp=False)[0]
+
     def eval_move(self,acc_angle):
         """
         Utility function for acc angle optimisation.
@@ -479,7 +519,7 @@ class Player(object):
         """
         Returns shortest distance to offensive end zone.
         """
-        if x == None:
+        if x is None:
             xuse = self.x
         else:
             xuse = x     
@@ -511,15 +551,4 @@ class Player(object):
             return True
         else:
             return False
-    
-    def standup(self):
-        """
-        Check if player is prone and if so whether they can stand yet.
-        """
-        if self.state==0:
-            if self.prone_counter <= 0:
-                self.prone_counter = -1
-                self.state=1
-            else:
-                self.prone_counter -= 1
             
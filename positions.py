@@ -3,12 +3,12 @@ Defines player positional behavoiour
 """
 import tools
 import player
-import pdb
 
 class Defender(player.Player):
     """
     Hang back to defend end zone.
     """
+    __slots__=('forward_limit',)
     def __init__(self,layout,x,y,jersey,team):
         # Class default stats
         size=1.
@@ -16,9 +16,10 @@ class Defender(player.Player):
         acc=3.0 # m/s/s
         strength=0.6
         throw_power=15. # m/s
-        self.find_space_update_time=2. # Every 2 seconds
-        forward_limit=30. # Roughly how far to push forward at most.
+        self.forward_limit=30. # Roughly how far to push forward at most.
         player.Player.__init__(self,layout,size,x,y,top_speed,acc,strength,throw_power,jersey,team)
+        # Rethink when the ball comes within (or goes beyond) the forward limit
+        layout.watch_zone(self.forward_limit)
 
     def set_ai_config(self):
         self.ai_config=list()
@@ -59,13 +60,14 @@ class Forward(player.Player):
     """
     Push forward and look for a pass
     """
-    pass
+    __slots__=()
 
 class Runner(player.Player):
     """
     In defence goes for loose ball or carrier. In offense runs to end zone.
     ??? In offence without the ball???
     """
+    __slots__=()
     def __init__(self,layout,x,y,jersey,team):
         # Class default stats
         size=1.
@@ -73,7 +75,6 @@ class Runner(player.Player):
         acc=3.0 # m/s/s
         strength=0.6
         throw_power=15. # m/s
-        self.find_space_update_time=2. # Every 2 seconds
         player.Player.__init__(self,layout,size,x,y,top_speed,acc,strength,throw_power,jersey,team)
 
     def set_ai_config(self):
@@ -108,6 +109,7 @@ class Bruiser(player.Player):
     """
     Simply tries to knock down nearest opponent.
     """
+    __slots__=()
     def __init__(self,layout,x,y,jersey,team):
         # Class default stats
         size=1.
@@ -140,6 +142,7 @@ class Catcher(player.Player):
     Basic test position for someone trying to get into a good spot to recieve
     a pass. For now, in defence just tries to kill the dill.
     """
+    __slots__=()
     def __init__(self,layout,x,y,jersey,team):
         # Class default stats
         size=1.
@@ -147,7 +150,6 @@ class Catcher(player.Player):
         acc=4.0
         strength=0.4
         throw_power=15.
-        self.find_space_update_time=2.
         player.Player.__init__(self,layout,size,x,y,top_speed,acc,strength,throw_power,jersey,team)
 
     def set_ai_config(self):
@@ -185,6 +187,7 @@ class Thrower(player.Player):
 
     At the moment acts like a Catcher without the ball.
     """
+    __slots__=()
     def __init__(self,layout,x,y,jersey,team):
         # Class default stats
         size=1.
@@ -192,7 +195,6 @@ class Thrower(player.Player):
         acc=8.
         strength=0.6
         throw_power=20.
-        self.find_space_update_time=2.
         player.Player.__init__(self,layout,size,x,y,top_speed,acc,strength,throw_power,jersey,team)
 
     def set_ai_config(self):
@@ -206,6 +208,7 @@ class Thrower(player.Player):
         " Get the ball "
         if self.pid == self.layout.ball.carrier:
             print("WTF")
+            import pdb
             pdb.set_trace()
         self.objective=self.get_loose_ball
 
@@ -1,7 +1,30 @@
 import sandbox
+import timing
 import cProfile
 import pstats
+import subprocess
+import sys
 
-cProfile.run('sandbox.runit(display=False)','profstats')
+def import_time(module='sandbox'):
+    """
+    Time to import a module in a fresh interpreter, with the heavy optional modules
+    (plotting, scipy, ...) it dragged in along the way.
+    """
+    code=("import sys, time\n"
+          "t=time.perf_counter()\n"
+          "import %s\n"
+          "print(time.perf_counter()-t)\n"
+          "print(' '.join(m for m in ('matplotlib','pylab','scipy','pdb') if m in sys.modules))\n" % module)
+    out=subprocess.check_output([sys.executable,'-c',code],universal_newlines=True).split('\n')
+    return float(out[0]), out[1].split()
+
+seconds, loaded = import_time()
+print("import sandbox: %.3f s, also loaded: %s" % (seconds,', '.join(loaded) or 'nothing heavy'))
+
+# Built in per phase timing of the ticks
+result=sandbox.lineup().run_game(display=False,replay_dir=None,profile=True)
+print(timing.format_report(result['profile']))
+
+cProfile.run('sandbox.lineup().run_game(display=False,replay_dir=None)','profstats')
 p = pstats.Stats('profstats')
 p.sort_stats('cumulative').print_stats(20)
@@ -0,0 +1,436 @@
+"""
+Recording and export of game replays.
+
+Each tick the Layout fills one frame, a (nplayers+1,) array of move_dtype with the
+players in pid order and the ball last, and passes it to a replay sink. Sinks either
+keep the frames in memory (MemorySink), stream them to disk as they come in
+(NDJSONSink, BinarySink, or JSONSink for the original single file layout) or drop
+them (NullSink). File sinks buffer a chunk of ticks and flush it as a whole, so memory
+stays flat however long the game runs and a game that dies part way still leaves every
+flushed tick on disk. Games stepped adaptively record through a ResampleSink, which
+passes frames on at a fixed rate.
+
+The binary replay format is columnar, for random access without parsing the file:
+
+    magic (8 bytes) | header length (uint32) | JSON header | padding to 8 bytes | ticks
+
+The header holds the player metadata (Layout.player_header) and the number of players.
+Every tick is then a fixed-width record of tick_dtype, with the x, y, angle and state of
+each player in pid order and the ball last, and the pid of the ball carrier. A
+ReplayReader maps the ticks with numpy.memmap, so any range of ticks can be sliced
+straight from disk.
+"""
+import json
+import os
+import struct
+import numpy as np
+
+# One move of one player (or the ball, pid 0) in one tick
+move_dtype=np.dtype([('pid',np.int32),
+                     ('x',np.float64),
+                     ('y',np.float64),
+                     ('angle',np.float64),
+                     ('have_ball',np.bool_),
+                     ('state',np.int8)])
+
+# File names within a replay directory
+header_file="test_header.js"
+ndjson_file="test.ndjson"
+json_file="test.js"
+binary_file="test.bin"
+
+# Start of a binary replay file
+binary_magic=b'SMASHRP1'
+
+def tick_dtype(nplayers):
+    """
+    Fixed-width record of one tick in a binary replay with nplayers players.
+    """
+    return np.dtype([('x','<f8',(nplayers+1,)),
+                     ('y','<f8',(nplayers+1,)),
+                     ('angle','<f8',(nplayers+1,)),
+                     ('state','i1',(nplayers+1,)),
+                     ('carrier','<i4')])
+
+def frames_to_ticks(frames):
+    """
+    Convert (nticks, nplayers+1) frames to binary replay records.
+    """
+    ticks=np.zeros(len(frames),dtype=tick_dtype(frames.shape[1]-1))
+    for name in ('x','y','angle','state'):
+        ticks[name]=frames[name]
+    # Frames mark the carrier with have_ball, in pid order with the ball last
+    has_carrier=frames['have_ball'][:,:-1].any(axis=1)
+    ticks['carrier']=np.where(has_carrier,frames['have_ball'][:,:-1].argmax(axis=1)+1,0)
+    return ticks
+
+def ticks_to_frames(ticks):
+    """
+    Convert binary replay records back to (nticks, nplayers+1) frames.
+    """
+    nplayers=ticks.dtype['x'].shape[0]-1
+    frames=np.zeros((len(ticks),nplayers+1),dtype=move_dtype)
+    frames['pid'][:,:nplayers]=np.arange(1,nplayers+1)
+    for name in ('x','y','angle','state'):
+        frames[name]=ticks[name]
+    carrier=np.asarray(ticks['carrier'])
+    frames['have_ball'][:,:nplayers]=carrier[:,None] == np.arange(1,nplayers+1)
+    frames['have_ball'][:,-1]=carrier != 0
+    return frames
+
+def empty_frame(nplayers):
+    """
+    Frame for nplayers players plus the ball, with the pids filled in.
+    """
+    frame=np.zeros(nplayers+1,dtype=move_dtype)
+    frame['pid'][:nplayers]=np.arange(1,nplayers+1)
+    return frame
+
+def fill_frame(frame,layout):
+    """
+    Fill a frame with the current state of the layout.
+    """
+    s=layout.store
+    ball=layout.ball
+    frame['x'][:-1]=s.x
+    frame['y'][:-1]=s.y
+    frame['angle'][:-1]=s.angle
+    frame['state'][:-1]=s.state
+    frame['have_ball'][:-1]=False
+    if ball.carrier != 0:
+        frame['have_ball'][ball.carrier-1]=True
+    # Ball position, use pid=0 for ball
+    frame[-1]=(0,ball.x,ball.y,0,ball.carrier != 0,0)
+    return frame
+
+def frames_to_list(frames):
+    """
+    Frames in the JSON replay layout, a list per tick of a dict per move.
+    """
+    names=move_dtype.names
+    return [[dict(zip(names,move)) for move in tick] for tick in frames.tolist()]
+
+class ReplaySink(object):
+    """
+    Destination for the frames of a game. Does nothing, subclasses override what they need.
+    """
+    def open(self,header,nplayers,nsteps):
+        """
+        Start a game.
+
+        Parameters
+        ----------
+        header : Layout.player_header, player metadata by pid
+        nplayers : number of players, frames are nplayers+1 long
+        nsteps : maximum number of ticks in the game
+        """
+        pass
+
+    def write(self,frame):
+        """
+        Take one tick's frame. The frame is reused by the caller, so copy what is kept.
+        """
+        pass
+
+    def close(self):
+        """
+        End the game, flushing anything still buffered.
+        """
+        pass
+
+class NullSink(ReplaySink):
+    """
+    Sink that drops everything, for games where no replay is wanted.
+    """
+    pass
+
+class MemorySink(ReplaySink):
+    """
+    Keeps every frame in a preallocated (nsteps, nplayers+1) structured array, growing
+    it if the game runs longer.
+    """
+    def __init__(self):
+        self.moves=np.zeros((0,0),dtype=move_dtype)
+        self.nticks=0
+
+    def open(self,header,nplayers,nsteps):
+        self.header=header
+        self.moves=np.zeros((max(nsteps,1),nplayers+1),dtype=move_dtype)
+        self.nticks=0
+
+    def write(self,frame):
+        if self.nticks == len(self.moves):
+            # Out of room, double up
+            self.moves=np.concatenate((self.moves,np.zeros_like(self.moves)))
+        self.moves[self.nticks]=frame
+        self.nticks += 1
+
+    def frames(self):
+        """
+        Structured array of the recorded ticks, (nticks, nplayers+1).
+        """
+        return self.moves[:self.nticks]
+
+    def to_list(self):
+        """
+        Recorded moves in the JSON replay layout, see frames_to_list.
+        """
+        return frames_to_list(self.frames())
+
+    def export(self,path):
+        """
+        Write the recorded moves as a single JSON replay.
+        """
+        with open(path,'w') as f:
+            f.write(json.dumps(self.to_list()))
+
+class FileSink(ReplaySink):
+    """
+    Base for sinks streaming to a replay directory. The header is written as JSON when
+    the game starts, frames are buffered and written out chunk ticks at a time.
+
+    Parameters
+    ----------
+    replay_dir : directory to write to, created if needed
+    chunk : number of ticks buffered between writes
+    """
+    data_file=None
+    mode='w'
+
+    def __init__(self,replay_dir,chunk=64):
+        self.replay_dir=replay_dir
+        self.chunk=chunk
+        self.f=None
+
+    def open(self,header,nplayers,nsteps):
+        os.makedirs(self.replay_dir,exist_ok=True)
+        with open(os.path.join(self.replay_dir,header_file),'w') as f:
+            f.write(json.dumps(header))
+        self.buffer=np.zeros((self.chunk,nplayers+1),dtype=move_dtype)
+        self.nbuffered=0
+        self.f=open(os.path.join(self.replay_dir,self.data_file),self.mode)
+
+    def write(self,frame):
+        self.buffer[self.nbuffered]=frame
+        self.nbuffered += 1
+        if self.nbuffered == self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the buffered ticks.
+        """
+        if self.nbuffered:
+            self.write_frames(self.buffer[:self.nbuffered])
+            self.nbuffered=0
+        self.f.flush()
+
+    def write_frames(self,frames):
+        " Write a block of frames to the open data file "
+        raise NotImplementedError
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f=None
+
+class NDJSONSink(FileSink):
+    """
+    Streams the replay as newline delimited JSON, one line per tick holding the list of
+    move dicts for that tick.
+    """
+    data_file=ndjson_file
+
+    def write_frames(self,frames):
+        self.f.write(''.join(json.dumps(tick)+'\n' for tick in frames_to_list(frames)))
+
+class JSONSink(FileSink):
+    """
+    Streams the replay in the original single JSON file layout, one list of ticks each
+    holding the list of move dicts for that tick. A game that dies part way leaves the
+    list unterminated.
+    """
+    data_file=json_file
+
+    def open(self,header,nplayers,nsteps):
+        FileSink.open(self,header,nplayers,nsteps)
+        self.f.write('[')
+        self.nwritten=0
+
+    def write_frames(self,frames):
+        ticks=[json.dumps(tick) for tick in frames_to_list(frames)]
+        self.f.write((', ' if self.nwritten else '') + ', '.join(ticks))
+        self.nwritten += len(ticks)
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.write(']')
+        FileSink.close(self)
+
+class BinarySink(FileSink):
+    """
+    Streams the replay in the columnar binary format, see ReplayReader.
+    """
+    data_file=binary_file
+    mode='wb'
+
+    def open(self,header,nplayers,nsteps):
+        FileSink.open(self,header,nplayers,nsteps)
+        meta=json.dumps(dict(players=header,nplayers=nplayers)).encode()
+        pad=-(len(binary_magic)+4+len(meta)) % 8
+        self.f.write(binary_magic + struct.pack('<I',len(meta)+pad) + meta + b' '*pad)
+
+    def write_frames(self,frames):
+        self.f.write(frames_to_ticks(frames).tobytes())
+
+class ReplayReader(object):
+    """
+    Random access to a binary replay, memory mapped rather than read.
+
+    Indexing or slicing gives tick_dtype records, e.g. reader[100:200]['x'] is the x of
+    every player and the ball over those ticks. A partly written last tick, from a game
+    that did not finish cleanly, is ignored.
+
+    Parameters
+    ----------
+    path : binary replay file, or a replay directory holding one
+    """
+    def __init__(self,path):
+        if os.path.isdir(path):
+            path=os.path.join(path,binary_file)
+        with open(path,'rb') as f:
+            if f.read(len(binary_magic)) != binary_magic:
+                raise ValueError("Not a binary replay: %s" % path)
+            nmeta,=struct.unpack('<I',f.read(4))
+            meta=json.loads(f.read(nmeta).decode())
+        self.path=path
+        # JSON turns the pid keys into strings
+        self.header=dict((int(pid),data) for pid, data in meta['players'].items())
+        self.nplayers=meta['nplayers']
+        self.dtype=tick_dtype(self.nplayers)
+        offset=len(binary_magic)+4+nmeta
+        nticks=(os.path.getsize(path)-offset)//self.dtype.itemsize
+        if nticks > 0:
+            self.ticks=np.memmap(path,dtype=self.dtype,mode='r',offset=offset,shape=(nticks,))
+        else:
+            self.ticks=np.zeros(0,dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __getitem__(self,index):
+        return self.ticks[index]
+
+    def frames(self,start=0,stop=None):
+        """
+        Iterate over the ticks from start to stop as (nplayers+1,) move_dtype frames,
+        reading from disk as it goes.
+        """
+        for tick in range(*slice(start,stop).indices(len(self.ticks))):
+            yield ticks_to_frames(self.ticks[tick:tick+1])[0]
+
+class TeeSink(ReplaySink):
+    """
+    Passes everything on to several sinks, e.g. to stream to disk and keep the game in
+    memory for display.
+    """
+    def __init__(self,*sinks):
+        self.sinks=sinks
+
+    def open(self,header,nplayers,nsteps):
+        for sink in self.sinks:
+            sink.open(header,nplayers,nsteps)
+
+    def write(self,frame):
+        for sink in self.sinks:
+            sink.write(frame)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+class ResampleSink(ReplaySink):
+    """
+    Passes frames written at irregular game times on to another sink at a fixed frame
+    rate, for games stepped adaptively. Each output frame is interpolated between the two
+    frames either side of it: positions linearly, angles along the shorter arc, and state
+    and possession taken from the nearer frame. Output frames are at 1/frame_rate,
+    2/frame_rate, ..., as a game stepped at dt=1/frame_rate would record them, plus the
+    last frame written if the game ends between two output frames.
+
+    Parameters
+    ----------
+    sink : ReplaySink to send the resampled frames to
+    frame_rate : output frames per second of game time
+    """
+    def __init__(self,sink,frame_rate):
+        self.sink=sink
+        self.frame_rate=float(frame_rate)
+        self.last=None
+
+    def open(self,header,nplayers,nsteps):
+        self.sink.open(header,nplayers,nsteps)
+        self.out=empty_frame(nplayers)
+        self.last=None
+        self.last_time=0.
+        self.nframes=0
+        self.written_time=0.
+
+    def write(self,frame):
+        " Take frame as the next output frame "
+        self.write_at(frame,(self.nframes+1)/self.frame_rate)
+
+    def write_at(self,frame,time):
+        """
+        Take the frame at game time time, which must be later than the last one.
+        """
+        if self.last is not None:
+            t0=self.last_time
+            while True:
+                t=(self.nframes+1)/self.frame_rate
+                if t > time + 1e-9:
+                    break
+                w=(t-t0)/(time-t0) if time > t0 else 1.
+                self.sink.write(self.interpolate(self.last,frame,w))
+                self.nframes += 1
+                self.written_time=t
+        self.last=frame.copy()
+        self.last_time=time
+
+    def interpolate(self,a,b,w):
+        " Frame a fraction w of the way from a to b "
+        out=self.out
+        out['pid']=b['pid']
+        out['x']=a['x'] + w*(b['x']-a['x'])
+        out['y']=a['y'] + w*(b['y']-a['y'])
+        turn=np.mod(b['angle']-a['angle']+np.pi,2.*np.pi)-np.pi
+        out['angle']=a['angle'] + w*turn
+        near=a if w < 0.5 else b
+        out['state']=near['state']
+        out['have_ball']=near['have_ball']
+        return out
+
+    def close(self):
+        if self.last is not None and self.last_time > self.written_time + 1e-9:
+            # Game ended between output frames, keep how it ended
+            self.sink.write(self.last)
+        self.last=None
+        self.sink.close()
+
+def read_ndjson(path):
+    """
+    Read a streamed NDJSON replay back as a list per tick of move dicts. A partial last
+    line, from a game that did not finish cleanly, is skipped.
+    """
+    moves=list()
+    with open(path) as f:
+        for line in f:
+            try:
+                moves.append(json.loads(line))
+            except ValueError:
+                break
+    return moves
@@ -1,7 +1,8 @@
 import tools
 import positions
 
-def runit(display=True):
+def lineup():
+    " Set up the test game "
     l=tools.Layout(100,50,50.,0.1)
     l.ball.x=30
     l.ball.y=25
@@ -50,6 +51,10 @@ def runit(display=True):
     #l.add_player(away_runner3)
     #l.add_player(away_runner4)
 
+    return l
+
+def runit(display=True):
+    l=lineup()
     l.run_game(display)
 
 #runit()
@@ -0,0 +1,127 @@
+"""
+Spatial hashing for broadphase collision detection.
+"""
+import numpy as np
+
+class SpatialHash(object):
+    """
+    Uniform grid broadphase.
+
+    Points are binned into square cells and only points in the same or neighbouring
+    cells are emitted as candidate pairs. With the cell size at least the largest
+    interaction distance, no pair closer than that can be missed. The grid is rebuilt
+    from scratch on every call to build, which is cheap (a sort) compared to testing
+    all pairs.
+    """
+    # Forward half of the 3x3 neighbourhood, so that each pair of cells is visited once.
+    neighbours=((0,1),(1,-1),(1,0),(1,1))
+
+    def __init__(self,cell_size):
+        self.cell_size=float(cell_size)
+        self.n=0
+
+    def build(self,x,y):
+        """
+        Bin the points (x,y) into cells.
+        """
+        self.n=len(x)
+        if self.n == 0:
+            return
+        cx=np.floor(np.asarray(x)/self.cell_size).astype(np.int64)
+        cy=np.floor(np.asarray(y)/self.cell_size).astype(np.int64)
+        cx -= cx.min()
+        cy -= cy.min()
+        # Pad the stride so that neighbouring y cells never alias across x columns
+        self.stride=cy.max()+3
+        key=(cx+1)*self.stride + cy+1
+        self.order=np.argsort(key,kind='stable')
+        self.keys=key[self.order]
+
+    def pairs(self):
+        """
+        Candidate pairs of points in the same or neighbouring cells.
+
+        Returns
+        -------
+        Tuple of index arrays (i,j) into the points passed to build, with i < j.
+        """
+        empty=np.zeros(0,dtype=np.int64)
+        if self.n < 2:
+            return (empty,empty)
+        isort=np.arange(self.n)
+        ilist=[empty]
+        jlist=[empty]
+        # Same cell, pair each point with those after it in sorted order
+        lo=isort+1
+        hi=np.searchsorted(self.keys,self.keys,side='right')
+        self._expand(isort,lo,hi,ilist,jlist)
+        # Neighbouring cells
+        for ox, oy in self.neighbours:
+            nkeys=self.keys + ox*self.stride + oy
+            lo=np.searchsorted(self.keys,nkeys,side='left')
+            hi=np.searchsorted(self.keys,nkeys,side='right')
+            self._expand(isort,lo,hi,ilist,jlist)
+        i=self.order[np.concatenate(ilist)]
+        j=self.order[np.concatenate(jlist)]
+        return (np.minimum(i,j),np.maximum(i,j))
+
+    def _expand(self,isort,lo,hi,ilist,jlist):
+        " Expand per point index ranges [lo,hi) of the sorted points into pairs "
+        counts=np.maximum(hi-lo,0)
+        total=counts.sum()
+        if total == 0:
+            return
+        starts=np.cumsum(counts)-counts
+        ilist.append(np.repeat(isort,counts))
+        jlist.append(np.repeat(lo,counts) + np.arange(total) - np.repeat(starts,counts))
+
+def time_of_impact(dx0,dy0,dx1,dy1,reach):
+    """
+    When pairs of circles moving in straight lines over a step first touch, so that
+    fast movers can't pass through each other between the start and end of the step.
+
+    Parameters
+    ----------
+    dx0, dy0 : separation of each pair at the start of the step
+    dx1, dy1 : separation of each pair at the end of the step
+    reach : distance at which each pair touches, i.e. the sum of their radii
+
+    Returns
+    -------
+    Tuple of arrays (toi, gap). toi is the fraction of the step at which the pair first
+    touches, 0 if they already do at the start and infinite if they never do. gap is the
+    closest they come during the step less reach, negative if they overlap.
+    """
+    vx=dx1-dx0
+    vy=dy1-dy0
+    a=vx**2 + vy**2
+    b=2.*(dx0*vx + dy0*vy)
+    c=dx0**2 + dy0**2 - reach**2
+    with np.errstate(divide='ignore',invalid='ignore'):
+        t_close=np.where(a > 0,np.clip(-b/(2.*a),0.,1.),0.)
+        gap=np.hypot(dx0+vx*t_close,dy0+vy*t_close) - reach
+        t_in=(-b-np.sqrt(np.maximum(b**2-4.*a*c,0.)))/(2.*a)
+    toi=np.where(c <= 0,0.,np.where(gap < 0,t_in,np.inf))
+    return (toi,gap)
+
+def closest_reach(px,py,wx,wy,stray):
+    """
+    How close pairs can get to each other over a step, when each pair's separation moves
+    in a straight line from (px,py) to anywhere within stray of (px+wx,py+wy).
+
+    That is the distance from the origin to the convex hull of the start point and the
+    disc of end points, min over t in [0,1] of |p + t*w| - t*stray. It is convex in t, so
+    the minimum is where the derivative vanishes, clipped to the step.
+
+    Returns
+    -------
+    Array of closest distances, zero where the end disc covers the origin.
+    """
+    w=np.hypot(wx,wy)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # Start point along and across the direction of travel
+        along=np.where(w > 0,(px*wx + py*wy)/w,0.)
+        across=np.where(w > 0,np.abs(px*wy - py*wx)/w,np.hypot(px,py))
+        t=np.where(w > stray,(stray*across/np.sqrt(w**2-stray**2) - along)/w,1.)
+    t=np.clip(np.nan_to_num(t,nan=1.),0.,1.)
+    return np.maximum(np.hypot(px+t*wx,py+t*wy) - t*stray,0.)
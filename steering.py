@@ -0,0 +1,100 @@
+"""
+Steering engine. Chooses the angle at which each player should accelerate so as
+to get as close as possible to their objective over the next tick.
+
+All functions here work on arrays, one entry per player, so a whole roster can be
+steered with a handful of NumPy operations.
+"""
+import numpy as np
+
+def project_moves(x,y,angle,speed,acc,top_speed,dt,acc_angle):
+    """
+    Array version of Player.project_move.
+
+    Projects players one tick by applying max acceleration at the given angles.
+    All arguments broadcast against each other.
+
+    Returns
+    -------
+    Tuple of the projected phase (x,y, angle, speed)
+    """
+    vx = speed*np.cos(angle) + acc*dt*np.cos(acc_angle)
+    vy = speed*np.sin(angle) + acc*dt*np.sin(acc_angle)
+
+    angle_new = np.arctan2(vy,vx)
+    speed_new = np.minimum(np.hypot(vx,vy),top_speed)
+
+    return (x + speed_new*np.cos(angle_new)*dt, y + speed_new*np.sin(angle_new)*dt,
+            angle_new, speed_new)
+
+def candidate_acc_angles(angle,speed,acc,top_speed,dt,dx,dy):
+    """
+    Closed form candidates for the best acceleration angle.
+
+    Works in velocity space. The velocities reachable in one tick lie on a circle
+    of radius acc*dt about the current velocity, which is then radially clamped to
+    the top speed. The distance to the desired velocity (dx,dy)/dt is unimodal along
+    each piece of that curve, so the optimum is one of:
+    * the point heading straight for the desired velocity (unclamped piece)
+    * the points whose direction matches the desired velocity (clamped piece)
+    * the tangent points seen from the origin (clamped piece turning points)
+    * the points where the circle crosses the top speed (piece boundaries)
+
+    Candidates that don't exist for a given player are returned as NaN.
+
+    Parameters
+    ----------
+    angle, speed : current direction (radians) and speed of motion
+    acc, top_speed : player kinematics
+    dt : time step
+    dx, dy : offset from player to objective
+
+    Returns
+    -------
+    Array of shape (N,7) of candidate acceleration angles.
+    """
+    vx = speed*np.cos(angle)
+    vy = speed*np.sin(angle)
+    ux = dx/dt
+    uy = dy/dt
+    r = acc*dt
+    vmag = np.hypot(vx,vy)
+    umag = np.hypot(ux,uy)
+    alpha = np.arctan2(vy,vx)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        # Straight at the desired velocity
+        direct = np.arctan2(uy-vy,ux-vx)
+        # Circle points lying along the desired direction
+        uhx = ux/umag
+        uhy = uy/umag
+        vu = vx*uhx + vy*uhy
+        root = np.sqrt(vu**2 - vmag**2 + r**2)
+        t_near = vu - root
+        t_far = vu + root
+        ray_near = np.arctan2(t_near*uhy-vy,t_near*uhx-vx)
+        ray_far = np.arctan2(t_far*uhy-vy,t_far*uhx-vx)
+        # Tangent points from the origin, only exist if the origin is outside the circle
+        tang = np.arccos(-r/vmag)
+        # Crossing points of the top speed
+        cross = np.arccos((top_speed**2 - vmag**2 - r**2)/(2.*r*vmag))
+
+    return np.stack((direct,ray_near,ray_far,alpha+tang,alpha-tang,alpha+cross,alpha-cross),axis=-1)
+
+def best_acc_angles(x,y,angle,speed,acc,top_speed,dt,x_objective,y_objective):
+    """
+    Returns the acceleration angle that takes each player closest to their objective.
+
+    Array replacement for minimising Player.eval_move one player at a time.
+    """
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    cands = candidate_acc_angles(angle,speed,acc,top_speed,dt,x_objective-x,y_objective-y)
+    # Evaluate every candidate and keep the best one
+    expand = lambda a : np.asarray(a,dtype=float)[...,np.newaxis]
+    xn, yn, an, sn = project_moves(expand(x),expand(y),expand(angle),expand(speed),expand(acc),
+                                   expand(top_speed),dt,cands)
+    err = np.hypot(xn-expand(x_objective),yn-expand(y_objective))
+    err[np.isnan(err)] = np.inf
+    ibest = np.argmin(err,axis=-1)
+    return np.take_along_axis(cands,ibest[...,np.newaxis],axis=-1)[...,0]
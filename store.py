@@ -0,0 +1,89 @@
+"""
+Struct-of-arrays storage for per-player state.
+
+A Layout owns one PlayerStore holding a contiguous array per state variable, with one
+row per registered player (row = pid-1). Player attributes such as x or state are
+StateField views onto their row, so a player can be used as a normal object while the
+Layout runs whole-roster updates as array operations.
+"""
+import numpy as np
+
+class StateField(object):
+    """
+    Descriptor exposing one column of a PlayerStore as a scalar attribute.
+
+    The owner must provide _store and _row.
+    """
+    __slots__=('name',)
+    def __init__(self,name):
+        self.name=name
+
+    def __get__(self,p,cls=None):
+        if p is None:
+            return self
+        return getattr(p._store,self.name).item(p._row)
+
+    def __set__(self,p,value):
+        getattr(p._store,self.name)[p._row]=value
+
+class PlayerStore(object):
+    """
+    Contiguous arrays of per-player state.
+
+    Arrays are always exactly as long as the number of rows. Adding a row reallocates
+    them, which is fine as players are only added while setting up a game.
+    """
+    fields=(('x',np.float64),
+            ('y',np.float64),
+            ('angle',np.float64),
+            ('current_speed',np.float64),
+            ('x_objective',np.float64),
+            ('y_objective',np.float64),
+            ('x_target',np.float64),
+            ('y_target',np.float64),
+            ('next_update',np.float64),
+            ('state',np.int8),
+            ('prone_counter',np.int32),
+            ('size',np.float64),
+            ('top_speed',np.float64),
+            ('acc',np.float64),
+            ('team',np.int8))
+
+    def __init__(self):
+        self.n=0
+        for name, dtype in self.fields:
+            setattr(self,name,np.zeros(0,dtype=dtype))
+
+    def add(self):
+        """
+        Append a zeroed row and return its index.
+        """
+        for name, dtype in self.fields:
+            setattr(self,name,np.append(getattr(self,name),np.zeros(1,dtype=dtype)))
+        self.n += 1
+        return self.n-1
+
+    def freeze(self,writable=()):
+        """
+        Make every column except those named in writable read-only, until thaw. Lets a
+        phase of the tick treat the store as a snapshot, failing loudly on any write.
+        """
+        for name, dtype in self.fields:
+            if name not in writable:
+                getattr(self,name).flags.writeable=False
+
+    def thaw(self):
+        """
+        Make every column writable again.
+        """
+        for name, dtype in self.fields:
+            getattr(self,name).flags.writeable=True
+
+    def adopt(self,other,row):
+        """
+        Append a copy of a row from another store and return its new index.
+        """
+        new_row=self.add()
+        for name, dtype in self.fields:
+            getattr(self,name)[new_row]=getattr(other,name)[row]
+        return new_row
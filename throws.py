@@ -0,0 +1,107 @@
+"""
+Precomputed throws, for planning passes without solving the flight of every option.
+
+A pass is thrown from release_height and caught when it drops back to that height (see
+Ball.launch). For a given power and distance the flattest throw that gets there is
+fixed, so its launch angle, flight time to catch height and landing range (where it
+would hit the ground if no one caught it) are tabulated once on a grid of power and
+distance, and looked up with bilinear interpolation. Distances beyond a power's range
+get the 45 degree throw, which goes as far as it can.
+
+Lookups are approximate, worst just short of a power's range where the angle changes
+fastest, so the table is for weighing up options. The throw actually made is solved
+exactly, see Ball.find_launch_angle.
+"""
+import numpy as np
+
+# Height passes are released and caught at, in metres
+release_height=2.
+
+# Tables already built, by gravity
+_tables=dict()
+
+def get_table(g):
+    """
+    Shared ThrowTable for gravity g, built on first use.
+    """
+    if g not in _tables:
+        _tables[g]=ThrowTable(g)
+    return _tables[g]
+
+class ThrowTable(object):
+    """
+    Launch angle, flight time to catch height and landing range by power and distance.
+
+    Parameters
+    ----------
+    g : gravity, see Ball.g
+    max_power : largest power in the table, more powerful throws are looked up at this
+    dpower, ddist : grid spacing of power (m/s) and distance (m)
+    """
+    # Columns of the table
+    columns=('angle','flight_time','catch_range','landing_range')
+
+    def __init__(self,g,max_power=40.,dpower=0.5,ddist=0.5):
+        self.g=float(g)
+        self.dpower=dpower
+        self.ddist=ddist
+        self.powers=np.arange(0.,max_power+dpower/2.,dpower)
+        self.dists=np.arange(0.,max_power**2/self.g+ddist/2.,ddist)
+        P, D = np.meshgrid(self.powers,self.dists,indexing='ij')
+        # sin of twice the launch angle, capped at the 45 degree throw
+        with np.errstate(divide='ignore',invalid='ignore'):
+            u=np.where(P > 0,np.minimum(D*self.g/P**2,1.),1.)
+        angle=np.arcsin(u)/2.
+        vspeed=P*np.sin(angle)
+        speed=P*np.cos(angle)
+        flight_time=2.*vspeed/self.g
+        landing_time=(vspeed + np.sqrt(vspeed**2 + 2.*self.g*release_height))/self.g
+        self.table=np.stack((angle,flight_time,speed*flight_time,speed*landing_time),axis=-1)
+
+    def lookup(self,power,dist):
+        """
+        Interpolated throw of the given power to the given distance.
+
+        Parameters
+        ----------
+        power, dist : floats or arrays of the same shape
+
+        Returns
+        -------
+        Tuple (angle, flight_time, catch_range, landing_range), each shaped like dist.
+        catch_range is short of dist where the throw can't reach.
+        """
+        fp=np.clip(np.asarray(power,dtype=float)/self.dpower,0.,len(self.powers)-1.)
+        fd=np.clip(np.asarray(dist,dtype=float)/self.ddist,0.,len(self.dists)-1.)
+        i=np.minimum(fp.astype(int),len(self.powers)-2)
+        j=np.minimum(fd.astype(int),len(self.dists)-2)
+        wp=(fp-i)[...,np.newaxis]
+        wd=(fd-j)[...,np.newaxis]
+        t=self.table
+        values=(1.-wp)*((1.-wd)*t[i,j] + wd*t[i,j+1]) + wp*((1.-wd)*t[i+1,j] + wd*t[i+1,j+1])
+        return tuple(values[...,k] for k in range(len(self.columns)))
+
+    def lead(self,power,x0,y0,x,y,vx,vy,iterations=4):
+        """
+        Where to throw to meet receivers running at constant velocity.
+
+        Starting from where each receiver is now, the flight time to their position that
+        much later is looked up, a few times over.
+
+        Parameters
+        ----------
+        power : throw power
+        x0, y0 : thrower position
+        x, y, vx, vy : receiver positions and velocities, floats or arrays
+
+        Returns
+        -------
+        Tuple (x, y, flight_time) of the target points and the flight time to them.
+        """
+        tx, ty = x, y
+        flight_time=0.
+        for it in range(iterations):
+            flight_time=self.lookup(power,np.hypot(tx-x0,ty-y0))[1]
+            tx=x + vx*flight_time
+            ty=y + vy*flight_time
+        return (tx,ty,flight_time)
@@ -0,0 +1,166 @@
+"""
+Low overhead timing of the stages of Layout.tick.
+
+The Layout calls lap after each stage of a tick, which adds the time since the previous
+lap to that stage. Objective evaluation is also broken down by objective method. A
+NullProfiler stands in when timing is off, so an untimed tick only pays for a few no-op
+calls.
+"""
+import time
+import numpy as np
+
+# Stages of a tick, in the order they run
+phases=('choose_dt',
+        'standup',
+        'helpers',
+        'objectives',
+        'prevent_friendly_collisions',
+        'move_players',
+        'detect_collisions',
+        'resolve_collisions',
+        'ball_move',
+        'check_possession',
+        'triggers',
+        'record')
+
+# Per tick percentiles given in the report
+percentiles=(50,90,99)
+
+class NullProfiler(object):
+    """
+    Profiler that records nothing.
+    """
+    def start(self):
+        pass
+
+    def lap(self,phase):
+        pass
+
+    def clock(self):
+        return 0.
+
+    def charge(self,phase,start):
+        pass
+
+    def objective(self,name):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        return None
+
+class TickProfiler(object):
+    """
+    Records the time spent in each phase of every tick.
+    """
+    def __init__(self):
+        self.times=dict((phase,list()) for phase in phases)
+        self.tick_times=list()
+        # Total time and number of calls by objective method name
+        self.objective_times=dict()
+        self.current=dict.fromkeys(phases,0.)
+        self.now=self.tick_start=time.perf_counter()
+
+    def start(self):
+        """
+        Start timing a tick.
+        """
+        for phase in phases:
+            self.current[phase]=0.
+        self.now=self.tick_start=time.perf_counter()
+
+    def lap(self,phase):
+        """
+        Charge the time since the last lap to phase.
+        """
+        now=time.perf_counter()
+        self.current[phase] += now-self.now
+        self.now=now
+
+    def clock(self):
+        """
+        Current time, to pass to charge.
+        """
+        return time.perf_counter()
+
+    def charge(self,phase,start):
+        """
+        Charge the time since start to phase, for work done in the middle of another phase,
+        such as a helper updated on demand. The time is taken out of the enclosing phase.
+        """
+        elapsed=time.perf_counter()-start
+        self.current[phase] += elapsed
+        self.now += elapsed
+
+    def objective(self,name):
+        """
+        Charge the time since the last lap to the objectives phase and the named objective.
+        """
+        now=time.perf_counter()
+        elapsed=now-self.now
+        self.current['objectives'] += elapsed
+        total=self.objective_times.setdefault(name,[0.,0])
+        total[0] += elapsed
+        total[1] += 1
+        self.now=now
+
+    def stop(self):
+        """
+        Finish timing a tick.
+        """
+        for phase in phases:
+            self.times[phase].append(self.current[phase])
+        self.tick_times.append(self.now-self.tick_start)
+
+    def report(self):
+        """
+        Structured timing report, all times in seconds.
+
+        Returns
+        -------
+        Dict with the number of ticks, total time, per tick statistics of whole ticks
+        ('tick'), the same for each phase ('phases', with each phase's share of the total)
+        and total, calls and mean per call of each objective method ('objectives').
+        """
+        tick_times=np.array(self.tick_times)
+        total=float(tick_times.sum())
+        report=dict(ticks=len(tick_times),total=total,tick=stats(tick_times))
+        report['phases']=dict()
+        for phase in phases:
+            report['phases'][phase]=stats(np.array(self.times[phase]))
+            report['phases'][phase]['share']=report['phases'][phase]['total']/total if total > 0 else 0.
+        report['objectives']=dict()
+        for name, (seconds, calls) in self.objective_times.items():
+            report['objectives'][name]=dict(total=seconds,calls=calls,mean=seconds/calls)
+        return report
+
+def stats(times):
+    """
+    Total, mean, max and percentiles of an array of per tick times.
+    """
+    if len(times) == 0:
+        return dict(total=0.,mean=0.,max=0.,**dict(('p%d' % q,0.) for q in percentiles))
+    result=dict(total=float(times.sum()),mean=float(times.mean()),max=float(times.max()))
+    for q, value in zip(percentiles,np.percentile(times,percentiles)):
+        result['p%d' % q]=float(value)
+    return result
+
+def format_report(report):
+    """
+    Timing report as a text table, times per tick in milliseconds.
+    """
+    columns=('mean',)+tuple('p%d' % q for q in percentiles)+('max',)
+    lines=["%d ticks, %.3f s, %.1f ticks/s" % (report['ticks'],report['total'],
+                                                 report['ticks']/report['total'] if report['total'] else 0.)]
+    lines.append("%-28s %6s" % ('phase (ms/tick)','share') + ''.join(' %8s' % c for c in columns))
+    rows=[(phase,report['phases'][phase]) for phase in phases] + [('tick',report['tick'])]
+    for name, s in rows:
+        share='%5.1f%%' % (100*s['share']) if 'share' in s else ''
+        lines.append("%-28s %6s" % (name,share) + ''.join(' %8.3f' % (1e3*s[c]) for c in columns))
+    lines.append("%-28s %8s %8s %8s" % ('objective','calls','total s','mean ms'))
+    objectives=sorted(report['objectives'].items(),key=lambda item: -item[1]['total'])
+    for name, s in objectives:
+        lines.append("%-28s %8d %8.3f %8.3f" % (name,s['calls'],s['total'],1e3*s['mean']))
+    return '\n'.join(lines)
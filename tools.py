@@ -1,19 +1,22 @@
+import concurrent.futures
 import math
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import pylab
 import numpy as np
-import json
 import helpers
-import itertools
+import replay
+import spatial
+import steering
+import store
+import throws
+import timing
 import utils
-import pdb
 
-def make_move_dict(pid,x,y,angle,have_ball,state):
-    """
-    Utility function to make a small dictionary to store a single move.
-    """
-    return dict(zip(['pid','x','y','angle','have_ball','state'],[pid,x,y,angle,have_ball,state]))
+# See helpers.time_eps
+time_eps=helpers.time_eps
+# Spreads scheduled updates of consecutive pids evenly over the update period
+golden_ratio=(math.sqrt(5.)-1.)/2.
+
+# Depth of the scoring zone at either end of the pitch
+end_zone_size=2.
 
 def make_player_dict(jersey,team,position):
     """
@@ -36,12 +39,45 @@ class Ball(object):
         self.x=float(x)
         self.y=float(y)
         self.z=0
-        self.flying = False
-        self.carrier = 0
+        self._flying = False
+        self._carrier = 0
         self.throw_pending = False
         self.xland = None
         self.yland = None
 
+    @property
+    def carrier(self):
+        " pid of the player holding the ball, 0 if no one "
+        return self._carrier
+
+    @carrier.setter
+    def carrier(self,pid):
+        old=self._carrier
+        if pid == old:
+            return
+        self._carrier=pid
+        events=self.layout.events
+        if old == 0:
+            events.post('caught',pid=pid)
+        elif pid == 0 and not self._flying:
+            events.post('dropped',pid=old)
+        events.post('carrier_changed',old=old,new=pid)
+
+    @property
+    def flying(self):
+        " Is the ball in the air "
+        return self._flying
+
+    @flying.setter
+    def flying(self,flying):
+        if flying == self._flying:
+            return
+        self._flying=flying
+        if flying:
+            self.layout.events.post('thrown',pid=self._carrier)
+        elif self._carrier == 0:
+            self.layout.events.post('landed')
+
     def move(self):
         """
         Collision detection with the ball. Move ball.
@@ -71,85 +107,129 @@ class Ball(object):
             self.y = p.y
 
     def fly_tick(self):
-        " Iterate one flight tick "
+        """
+        Iterate one flight tick.
+
+        The flight is solved in closed form at launch, see launch. Each tick only tests
+        the players whose reachable region can meet the ball during the tick, and finds
+        the exact time the ball would pass within their reach.
+        """
         # Check for potential catchers
         # Assume we can only catch if z <= 2 metres.
         # TODO: Player heights and jumping??
-
-        addx, addy = utils.components(self.speed*self.layout.dt,self.angle)
-
-        if self.z <= 2:
-            # Ball at catchable height
-            # Eqn of ball travelling line as ax + bx + c = 0
-            x2 = self.x + addx
-            y2 = self.y + addy
-            a = self.y - y2
-            b = x2 - self.x
-            c = (self.x - x2)*self.y + (y2 - self.y)*self.x
-            midx = (self.x + x2)/2.
-            midy = (self.y + y2)/2.
-            dflight = self.speed*self.layout.dt
-            def catch_score(p):
-                # Returns postion along flight path of ball for given player
-                # Returns None if the player can't catch ball from their position
+        t0 = self.t_flight
+        t1 = min(t0 + self.layout.dt,self.t_end)
+        lo = max(t0,self.t_catch)
+        # TODO: At the moment, first eligble catcher automatically catches. Need to implement skill
+        # based chance, constested catches, etc.    
+        best_t=np.inf
+        pcatch=None
+        if lo <= t1:
+            rows = np.flatnonzero((self.reach_start <= t1) & (self.reach_stop >= lo))
+            for row in rows:
+                p = self.layout.players[row+1]
                 if not p.want_to_catch: 
-                    return None
-                dist = abs(a*p.x + b* p.y + c)/np.sqrt(a**2 + b**2)
-                if dist > p.size: 
-                    return None
-                # Check the position is bracketted in the flight delta
-                elif np.sqrt( (midx-p.x)**2 + (midy-p.y)**2) > dflight/2. + p.size:
-                    return None
-                else:
-                    return np.sqrt((p.x-self.x)**2 + (p.y-self.y)**2)
-            # TODO: At the moment, first eligble catcher automatically catches. Need to implement skill
-            # based chance, constested catches, etc.    
-            best_score=1000.
-            pcatch=None
-            for p in self.layout.players.values():
-                s = catch_score(p)
-                if s != None:
-                    if s < best_score:
-                        best_score=s
-                        pcatch=p
-            if pcatch != None:
-                # Player had made catch
-                print("caught it",pcatch.pid)
-                self.carrier=pcatch.pid
-                self.flying=False
-                self.x = pcatch.x
-                self.y = pcatch.y
-                return
-        
-        self.x += addx
-        self.y += addy
-        # Check for out of bounds
-        oob=False
-        if self.x < 0:
-            self.x = 0
-            oob = True
-        elif self.x > self.layout.xsize:
-            self.x = self.layout.xsize
-            oob = True
-        if self.y < 0:
-            self.y = 0
-            oob = True
-        elif self.y > self.layout.ysize:
-            self.y = self.layout.ysize
-            oob = True
-
-        if oob:
+                    continue
+                t = self.catch_time(p,lo,t1)
+                if t < best_t:
+                    best_t=t
+                    pcatch=p
+        if pcatch != None:
+            # Player had made catch
+            print("caught it",pcatch.pid)
+            self.carrier=pcatch.pid
+            self.flying=False
+            self.x = pcatch.x
+            self.y = pcatch.y
+            return
+
+        self.t_flight = t1
+        self.x, self.y, self.z = self.flight_position(t1)
+        self.vspeed = self.vspeed0 - self.g*t1
+        if t1 >= self.t_end:
             self.flying = False
-            self.vspeed=0
-            self.speed=0
-            self.z=0
-            self.xland=self.x
-            self.yland=self.y
-        else:
-            self.vspeed += -self.g * self.layout.dt
-            self.z += self.vspeed * self.layout.dt
-            if self.z <= 0.:
-                self.flying = False
+            if self.t_oob <= self.t_ground:
+                # Out of bounds
+                self.x = utils.bracket(0,self.x,self.layout.xsize)
+                self.y = utils.bracket(0,self.y,self.layout.ysize)
+                self.vspeed=0
+                self.speed=0
+                self.z=0
+                self.xland=self.x
+                self.yland=self.y
+            else:
+                self.z=0.
+
+    def flight_position(self,t):
+        " Position (x,y,z) of the ball t seconds after launch "
+        return (self.x0 + self.vx*t, self.y0 + self.vy*t,
+                self.z0 + self.vspeed0*t - 0.5*self.g*t**2)
+
+    def catch_time(self,p,t0,t1):
+        """
+        Earliest time in [t0,t1] at which the ball passes within reach (size) of the
+        player at their current position. Infinite if it doesn't.
+        """
+        wx = self.x0 - p.x
+        wy = self.y0 - p.y
+        a = self.vx**2 + self.vy**2
+        b = 2.*(wx*self.vx + wy*self.vy)
+        c = wx**2 + wy**2 - p.size**2
+        if a == 0.:
+            # Ball going straight up and down
+            return t0 if c <= 0. else np.inf
+        disc = b**2 - 4.*a*c
+        if disc < 0.:
+            return np.inf
+        root = math.sqrt(disc)
+        start = max((-b-root)/(2.*a),t0)
+        if start > min((-b+root)/(2.*a),t1):
+            return np.inf
+        return start
+
+    def reach_windows(self):
+        """
+        Time window, for each player, in which they could possibly get to the ball while
+        it is catchable, given where they are now and their top speed. Outside this window
+        there is no need to test them for a catch.
+
+        Solves |B(t) - P| <= R + s*t for the ball ground track B(t), where P is the
+        player position, s their top speed, and R their size plus a margin for being
+        pushed around.
+
+        Returns
+        -------
+        Tuple of arrays (start, stop) by row. Start is infinite where the player can't
+        reach the ball at all.
+        """
+        reach_margin=1.
+        s=self.layout.store
+        wx = self.x0 - s.x
+        wy = self.y0 - s.y
+        R = s.size + reach_margin
+        a = self.vx**2 + self.vy**2 - s.top_speed**2
+        b = 2.*(wx*self.vx + wy*self.vy - R*s.top_speed)
+        c = wx**2 + wy**2 - R**2
+        with np.errstate(divide='ignore',invalid='ignore'):
+            root = np.sqrt(b**2 - 4.*a*c)
+            r1 = np.minimum((-b-root)/(2.*a),(-b+root)/(2.*a))
+            r2 = np.maximum((-b-root)/(2.*a),(-b+root)/(2.*a))
+            t_lin = -c/b
+        never = np.full(s.n,np.inf)
+        # Ball faster than player, reachable between the roots
+        start = np.where(a > 0,np.where(np.isnan(root),never,r1),0.)
+        stop = np.where(a > 0,r2,np.inf)
+        # Player faster than ball, reachable outside the roots
+        late = (a < 0) & ~np.isnan(root) & (r1 < self.t_catch)
+        start = np.where(late,np.maximum(r2,self.t_catch),start)
+        # Equal speeds, reachable after (or before) a single crossing
+        lin = a == 0
+        start = np.where(lin & (b < 0),t_lin,start)
+        stop = np.where(lin & (b > 0),t_lin,stop)
+        start = np.maximum(start,self.t_catch)
+        stop = np.minimum(stop,self.t_end)
+        start[start > stop] = np.inf
+        return (start,stop)
 
     def throw(self,elv,power,target_x,target_y):
         """
@@ -163,16 +243,43 @@ class Ball(object):
         """
         Initialise throw with given angle and power from current ball position.
         """
+        # Take off before letting go, so the release is seen as a throw not a drop
+        self.flying = True
         self.carrier=0
         self.z=2. # Assume passes start 2m off the ground.
         self.angle = math.atan2(target_y-self.y,target_x-self.x)
         self.speed = power*math.cos(elv)
         self.vspeed = power*math.sin(elv)
-        self.flying = True
         dist = power**2 * math.sin(2.*elv)/self.g
         dx, dy = utils.components(dist,self.angle)
         self.xland = self.x + dx
         self.yland = self.y + dy
+        # Solve the whole flight now.
+        self.t_flight = 0.
+        self.x0, self.y0, self.z0 = self.x, self.y, self.z
+        self.vx, self.vy = utils.components(self.speed,self.angle)
+        self.vspeed0 = self.vspeed
+        # Catchable once the ball drops back to the release height
+        self.t_catch = max(2.*self.vspeed0/self.g,0.)
+        self.t_ground = (self.vspeed0 + math.sqrt(self.vspeed0**2 + 2.*self.g*self.z0))/self.g
+        # Time the ground track leaves the pitch
+        t_oob = np.inf
+        if self.vx > 0:
+            t_oob = min(t_oob,(self.layout.xsize-self.x0)/self.vx)
+        elif self.vx < 0:
+            t_oob = min(t_oob,-self.x0/self.vx)
+        if self.vy > 0:
+            t_oob = min(t_oob,(self.layout.ysize-self.y0)/self.vy)
+        elif self.vy < 0:
+            t_oob = min(t_oob,-self.y0/self.vy)
+        self.t_oob = t_oob
+        self.t_end = min(self.t_ground,self.t_oob)
+        self.reach_start, self.reach_stop = self.reach_windows()
+
+    @property
+    def throws(self):
+        " Precomputed throws for this gravity, see throws.ThrowTable "
+        return throws.get_table(self.g)
 
     def find_launch_angle(self,power,x_target,y_target):
          """
@@ -189,35 +296,135 @@ class Ball(object):
         """
         Scatters the ball by up to amount in a random direction.
         """
-        self.x += np.random.random()*amount-amount/2.
-        self.y += np.random.random()*amount-amount/2.
+        self.x += self.layout.rng.random()*amount-amount/2.
+        self.y += self.layout.rng.random()*amount-amount/2.
         self.x = utils.bracket(0,self.x,self.layout.xsize)
         self.y = utils.bracket(0,self.y,self.layout.ysize)
 
+class RandomStream(object):
+    """
+    Uniform random numbers for a game, drawn in blocks from its own np.random.Generator.
+
+    Draws from a stream only depend on its seed and the order they are made in, never
+    on any other game running in the same process.
+    """
+    def __init__(self,seed=None,block=256):
+        self.seed=seed
+        self.generator=np.random.default_rng(seed)
+        self.block=block
+        self.refill()
+
+    def refill(self):
+        " Pre-draw the next block "
+        self.buffer=self.generator.random(self.block).tolist()
+        self.i=0
+
+    def random(self):
+        " Next uniform number in [0,1) "
+        if self.i == self.block:
+            self.refill()
+        self.i += 1
+        return self.buffer[self.i-1]
+
 class Layout(object):
     """
     Base(?) class for the backdrop in which stuff happens.
+
+    Parameters
+    ----------
+    seed : seed of the game's random stream. Anything np.random.SeedSequence accepts, or a
+           SeedSequence. Games with the same seed (and players) play out the same.
+    workers : number of threads evaluating objectives, None to evaluate them in turn. The
+              game plays out the same either way, see run_objectives. When profiling
+              with workers, objectives are only timed as a whole, helpers included.
+    adaptive : choose the length of each tick, from dt up to dt_max, see choose_dt
+    dt_max : longest tick when stepping adaptively, 10*dt by default
+    frame_rate : frames per second of game time recorded when stepping adaptively, 1/dt
+                 by default
     """
-    def __init__(self,xsize,ysize,game_length,dt=0.1):
+    def __init__(self,xsize,ysize,game_length,dt=0.1,steering_mode='analytic',seed=None,workers=None,
+                 adaptive=False,dt_max=None,frame_rate=None):
         self.xsize=float(xsize)
         self.ysize=float(ysize)       
+        # Changes of game state, e.g. the ball being caught, are posted here during a tick
+        self.events=EventBus()
         self.ball=Ball(self,self.xsize/2.,self.ysize/2.)
         self.players=dict()
+        # Per-player state arrays, row pid-1. Player attributes are views onto these.
+        self.store=store.PlayerStore()
+        # Collisions found in the tick, as (player, player, overlap, time of impact)
         self.collisions=list()
+        # Positions at the start of the move, for sweeping collisions over the tick
+        self.x_start=None
+        self.y_start=None
         self.game_length=game_length
         self.dt=dt
         self.nsteps = int(self.game_length/self.dt)
-        # Save all moves
-        self.moves=list()
-        # Store step number
+        # Adaptive steps are whole multiples (substeps) of the base step, dt_min. dt is the
+        # length of the current tick.
+        self.adaptive=adaptive
+        self.dt_min=dt
+        self.dt_max=10.*dt if dt_max is None else max(dt_max,dt)
+        self.frame_rate=1./dt if frame_rate is None else frame_rate
+        self.substeps=1
+        self.reseed(seed)
+        # How players choose their acceleration. 'analytic' solves for all players at
+        # once, 'fmin' is the original per player minimisation, kept for reference.
+        self.steering_mode=steering_mode
+        # Where each tick's moves go, see run_game. The frame is set up on the first tick
+        # once all players are in. The recorder is the in-memory sink, if there is one.
+        self.sink=replay.NullSink()
+        self.frame=None
+        self.recorder=None
+        # Store step number, base steps played and game time
         self.istep=0
+        self.ifine=0
+        self.time=0.
+        # Times the phases of each tick when profiling, see run_game
+        self.profiler=timing.NullProfiler()
+        # Threads for objective evaluation, only running during run_game
+        self.workers=workers
+        self.pool=None
+        # Set while objectives run on the pool, when the profiler is left to the main thread
+        self.threaded=False
+        # Game outcome. Team that scored (0 if no one), team last in possession and the
+        # number of times possession has changed team.
+        self.scorer=0
+        self.possession=0
+        self.turnovers=0
         # Store list of all triggers in use here, in order to loop over in one place.
-        self.triggers = list()
-        # Init list of helpers
-        self.helpers = dict()
+        # Keyed by trigger class, each is subscribed to the events it cares about.
+        self.triggers = dict()
+        # Depths from either end at which the ball crossing over is posted as an event, see
+        # watch_zone. Each maps to whether the ball is within it at the (low x, high x) end.
+        self.zones = dict()
+        # Init list of helpers, updated when used. Bring them all up to date when the ball
+        # changes hands.
+        self.helpers = helpers.HelperGraph(self)
+        self.events.subscribe('carrier_changed',self.helpers.wake)
+        # Players rethink straight away too, even if they stick with the same objective
+        self.events.subscribe('carrier_changed',self.reschedule)
+        self.helpers['roster']=helpers.Roster(self)
         self.helpers['pb_eqs']=helpers.BallCarrierPBeqs(self)
         self.helpers['maps']=helpers.Maps(self)
-        #self.helpers['maps']=helpers.HazardMaps(self)
+        # Coarse hazard grid shared by receivers looking for space
+        self.helpers['hazard']=helpers.HazardMaps(self,nx=50,ny=25)
+
+    def reseed(self,seed=None):
+        """
+        Start a fresh random stream for the game from the given seed.
+        """
+        if not isinstance(seed,np.random.SeedSequence):
+            seed=np.random.SeedSequence(seed)
+        self.seed=seed
+        self.rng=RandomStream(seed)
+
+    def spawn_seeds(self,n):
+        """
+        Seeds for n independent child streams of this game's seed, e.g. for games played
+        by parallel workers.
+        """
+        return self.seed.spawn(n)
 
     def add_player(self,player):
         """
@@ -225,21 +432,66 @@ class Layout(object):
         """
         player.pid = len(self.players)+1
         self.players[player.pid]=player
-        for ai in player.ai_config:
-            # Is this trigger already used?
-            indx = np.where([ trig.__class__ == ai[0] for trig in self.triggers])
-            if len(indx) == 0:
-                self.triggers[indx].add_callback(ai[1])
-            else:
-                self.triggers.append(ai[0](self))
-                self.triggers[len(self.triggers)-1].add_callback(ai[1])
-
-    def frame_data(self):
-        nticks=len(self.moves)
-        iframe=0
-        while iframe < nticks:
-            moves=self.moves[iframe]
-            iframe = iframe + 1
+        # Move player state into the layout arrays
+        player._row = self.store.adopt(player._store,player._row)
+        player._store = self.store
+        for trigger_class, callback in player.ai_config:
+            if trigger_class not in self.triggers:
+                trig=trigger_class(self)
+                for event in trig.events:
+                    self.events.subscribe(event,trig.notify)
+                self.triggers[trigger_class]=trig
+            self.triggers[trigger_class].add_callback(callback)
+
+    def watch_zone(self,depth):
+        """
+        Post 'ball_entered_zone' and 'ball_left_zone' events whenever the ball crosses depth
+        metres from either end of the pitch. For players whose choices depend on how near
+        the ball is to an end zone, which triggers otherwise only look at on changes of
+        possession.
+        """
+        if depth not in self.zones:
+            self.zones[depth]=(self.ball.x < depth,self.ball.x > self.xsize-depth)
+
+    def check_zones(self):
+        """
+        Post an event for each watched zone the ball has entered or left since last time.
+        """
+        x=self.ball.x
+        for depth, was in self.zones.items():
+            now=(x < depth,x > self.xsize-depth)
+            for end, before, after in zip((-1,1),was,now):
+                if after and not before:
+                    self.events.post('ball_entered_zone',depth=depth,end=end)
+                elif before and not after:
+                    self.events.post('ball_left_zone',depth=depth,end=end)
+            self.zones[depth]=now
+
+    @property
+    def moves(self):
+        " All moves kept in memory, in the JSON replay layout, see replay.frames_to_list "
+        if self.recorder is None:
+            return list()
+        return self.recorder.to_list()
+
+    def frame_data(self,reader=None):
+        """
+        Iterate over the frames of the game, see replay.
+
+        Parameters
+        ----------
+        reader : replay.ReplayReader (or path to a binary replay) to iterate over, read
+                 from disk tick by tick, rather than the game kept in memory
+        """
+        if reader is not None:
+            if not isinstance(reader,replay.ReplayReader):
+                reader=replay.ReplayReader(reader)
+            for moves in reader.frames():
+                yield moves
+            return
+        if self.recorder is None:
+            return
+        for moves in self.recorder.frames():
             yield moves
 
     def frame_display(self,frame_data):
@@ -261,8 +513,25 @@ class Layout(object):
             p.set_color(col)
             
 
-    def run_game(self,display=True):
-        " Run the game "
+    def run_game(self,display=True,replay_dir=None,sink=None,profile=False):
+        """
+        Run the game.
+
+        Parameters
+        ----------
+        display : animate the game once it's over
+        replay_dir : directory to stream an NDJSON replay to, None to not write it
+        sink : replay.ReplaySink to send the moves to, instead of the one replay_dir sets up.
+               Use replay.MemorySink to keep the whole game in memory, or replay.JSONSink
+               for the original single JSON file (test.js).
+        profile : time each phase of every tick, see profile_report. With workers only
+                  the phase totals are kept, objectives aren't broken down by method and
+                  helpers they update are timed as part of the objectives phase.
+
+        Returns
+        -------
+        Outcome of the game, see result.
+        """
         # Setup move storage
         self.player_header=dict()
         for p in self.players.values():
@@ -271,22 +540,51 @@ class Layout(object):
         # Add ball to player_header
         self.player_header[0]=make_player_dict(0,0,'null')#player_data(0,0,'null')
         # Add inits here? I.e. special player method to set initial objectives?
-        for trig in self.triggers:
+        for trig in self.triggers.values():
             trig.init()
+        if profile:
+            self.profiler=timing.TickProfiler()
+        # Setup replay output
+        if sink is None:
+            if replay_dir is not None:
+                sink=replay.NDJSONSink(replay_dir)
+            else:
+                sink=replay.NullSink()
+        if isinstance(sink,replay.MemorySink):
+            self.recorder=sink
+        elif display:
+            # Animating needs the whole game in memory
+            self.recorder=replay.MemorySink()
+            sink=replay.TeeSink(sink,self.recorder)
+        if self.adaptive:
+            # Ticks come at irregular times, record at a fixed rate
+            sink=replay.ResampleSink(sink,self.frame_rate)
+            nframes=int(self.game_length*self.frame_rate)+1
+        else:
+            nframes=self.nsteps
+        self.sink=sink
+        self.sink.open(self.player_header,len(self.players),nframes)
+        if self.adaptive:
+            self.frame=replay.empty_frame(self.store.n)
+            self.sink.write_at(replay.fill_frame(self.frame,self),self.time)
+        if self.workers is not None and self.workers > 1:
+            self.pool=concurrent.futures.ThreadPoolExecutor(self.workers)
         # Run it
-        for i in range(self.nsteps):
-            self.tick()
-            if self.check_scoring():
-                break
-        # Dump to JSON
-        jfile = "/home/matt/smash/games/test_header.js"
-        with open(jfile,'w') as f:
-            f.write(json.dumps(self.player_header))
-        jfile = "/home/matt/smash/games/test.js"
-        with open(jfile,'w') as f:
-            f.write(json.dumps(self.moves))        
+        try:
+            while self.ifine < self.nsteps:
+                self.tick()
+                if self.check_scoring():
+                    break
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool=None
+            self.sink.close()
         # Display results
         if display:
+            # Plotting is only loaded when needed, so headless games start quickly
+            import matplotlib.pyplot as plt
+            import matplotlib.animation as animation
             fig1=plt.figure()
             plt.xlim([0,self.xsize])
             plt.ylim([0,self.ysize])
@@ -302,57 +600,301 @@ class Layout(object):
             self.plots.append(plot_now)
             line_ani = animation.FuncAnimation(fig1,self.frame_display,self.frame_data,interval=20,blit=False,repeat=True)
             plt.show()
+        return self.result()
+
+    def result(self):
+        """
+        Summary of the game outcome as a small dict.
+        """
+        result=dict(scorer=self.scorer,ticks=self.istep,turnovers=self.turnovers,time=self.time)
+        report=self.profile_report()
+        if report is not None:
+            result['profile']=report
+        return result
+
+    def profile_report(self):
+        """
+        Per phase timing of the ticks so far, see timing.TickProfiler.report. None if the
+        game is not being profiled.
+        """
+        return self.profiler.report()
 
     def tick(self):
         """
         Iterate one tick.
         """
+        prof=self.profiler
+        prof.start()
+        if self.adaptive:
+            self.dt=self.choose_dt()
+        prof.lap('choose_dt')
         # Stand prone players up
-        for p in self.players.values():
-            p.standup()
-        # update helpers
-        for h in self.helpers.values():
-            h.update()
-        # Run current objective functions for all players.
-        for p in self.players.values():
-            p.objective()
-            p.objective_sanity()
+        self.standup()
+        prof.lap('standup')
+        # Run current objective functions that are due.
+        self.run_objectives()
         # Ensure players on the same team are not attempting to run into each other
         self.prevent_friendly_collisions()
+        prof.lap('prevent_friendly_collisions')
         # Move all players
-        for p in self.players.values():
-            p.move()
+        self.x_start=self.store.x.copy()
+        self.y_start=self.store.y.copy()
+        self.move_players()
+        prof.lap('move_players')
         self.detect_collisions()
+        prof.lap('detect_collisions')
         self.resolve_collisions()
+        prof.lap('resolve_collisions')
         self.ball.move()
-        # Run triggers
-        for trig in self.triggers:
-            trig.check()
+        self.check_zones()
+        prof.lap('ball_move')
+        self.check_possession()
+        prof.lap('check_possession')
+        # Run triggers for whatever changed this tick
+        self.events.dispatch()
+        prof.lap('triggers')
         # Store moves
-        # Somewhat dodgy, but this will need to be dumped to a DB soon anyway.
-        tick_moves=list()
-        for p in self.players.values():
-            have_ball = p.pid == self.ball.carrier
-            #add_move=move_data(p.pid,p.x,p.y,p.angle,have_ball,p.state)
-            add_move=make_move_dict(p.pid,p.x,p.y,p.angle,have_ball,p.state)
-            tick_moves.append(add_move)
-        # Ball position,use pid=0 for ball
-        ball_carried = self.ball.carrier != 0
-        add_move=make_move_dict(0,self.ball.x,self.ball.y,0,ball_carried,0)
-        tick_moves.append(add_move)
-        #
-        self.moves.append(tick_moves)
+        if self.frame is None:
+            self.frame=replay.empty_frame(self.store.n)
+        if self.adaptive:
+            self.sink.write_at(replay.fill_frame(self.frame,self),self.time+self.dt)
+        else:
+            self.sink.write(replay.fill_frame(self.frame,self))
+        prof.lap('record')
+        prof.stop()
         self.istep += 1
+        self.ifine += self.substeps
+        self.time += self.dt
+
+    def choose_dt(self):
+        """
+        Length of the next tick when stepping adaptively.
+
+        The tick is the longest whole number of base steps, up to dt_max, in which nothing
+        can happen that the base step would catch and a longer one might miss:
+        - no two standing opponents can come into contact (see contact_steps),
+        - the ball can't reach a player who might catch or pick it up, land, or be carried
+          over the line,
+        - no prone player's count runs out part way through.
+        Anywhere near contact it falls back to the base step, dt_min.
+
+        In crowded games that is much of the time, so the saving is modest. Over ten
+        games each, the sandbox game takes about 0.6 ticks for every base step of play,
+        a 16 player generated lineup about 0.75 and a 64 player one close to 1.
+        """
+        s=self.store
+        kmax=max(int(self.dt_max/self.dt_min + time_eps),1)
+        kmax=min(kmax,self.nsteps-self.ifine)
+        # Prone players whose count is up stand up at the start of the tick
+        prone=(s.state == 0) & (s.prone_counter > 0)
+        if prone.any():
+            kmax=min(kmax,int(s.prone_counter[prone].min()))
+        kmax=min(kmax,int(self.ball_event_time()/self.dt_min + time_eps))
+        if kmax > 1:
+            kmax=self.contact_steps(np.flatnonzero(~prone),kmax)
+        self.substeps=max(kmax,1)
+        return self.substeps*self.dt_min
+
+    def contact_steps(self,rows,kmax):
+        """
+        Largest number of base steps, at most kmax, in which none of the players in rows
+        can come into contact with an opponent.
+
+        A tick of length h moves each player in a straight line, at their velocity after
+        one change of at most acc*h, which also can't take them past top_speed. So a
+        pair's separation moves from where it is now to somewhere within a stray
+        distance of where their current velocities would take it, and they can't touch
+        if that whole region stays further apart than their sizes (see
+        spatial.closest_reach). Whether a tick is safe only gets less likely as it gets
+        longer, so the longest safe one is found by bisection.
+        """
+        if len(rows) < 2:
+            return kmax
+        s=self.store
+        i, j = np.triu_indices(len(rows),k=1)
+        i, j = rows[i], rows[j]
+        # Team mates just run through each other, see resolve_collisions
+        rival=s.team[i] != s.team[j]
+        i, j = i[rival], j[rival]
+        # Pairs that couldn't meet even at top speed can be left out
+        dx=s.x[j]-s.x[i]
+        dy=s.y[j]-s.y[i]
+        reach=s.size[i]+s.size[j]
+        near=np.hypot(dx,dy)-reach <= (s.top_speed[i]+s.top_speed[j])*kmax*self.dt_min
+        i, j, dx, dy, reach = i[near], j[near], dx[near], dy[near], reach[near]
+        if len(i) == 0:
+            return kmax
+        speed=s.current_speed
+        vx=speed[j]*np.cos(s.angle[j]) - speed[i]*np.cos(s.angle[i])
+        vy=speed[j]*np.sin(s.angle[j]) - speed[i]*np.sin(s.angle[i])
+
+        def safe(k):
+            h=k*self.dt_min
+            stray=(np.minimum(s.acc[i]*h,speed[i]+s.top_speed[i]) +
+                   np.minimum(s.acc[j]*h,speed[j]+s.top_speed[j]))*h
+            return (spatial.closest_reach(dx,dy,vx*h,vy*h,stray) > reach).all()
+
+        if safe(kmax):
+            return kmax
+        lo, hi = 1, kmax
+        while hi - lo > 1:
+            k=(lo+hi)//2
+            if safe(k):
+                lo=k
+            else:
+                hi=k
+        return lo
+
+    def ball_event_time(self):
+        """
+        Game time until the ball could next change hands, land or score, as far as can be
+        told now. Zero if it could happen straight away.
+        """
+        ball=self.ball
+        s=self.store
+        if ball.throw_pending:
+            return 0.
+        if ball.flying:
+            t=ball.t_flight
+            if ((ball.reach_start <= t + time_eps) & (ball.reach_stop >= t)).any():
+                # Someone could be catching it
+                return 0.
+            upcoming=ball.reach_start[ball.reach_start > t]
+            return min(ball.t_end,upcoming.min() if len(upcoming) else np.inf) - t
+        if ball.carrier == 0:
+            # Time for the nearest player to get to a loose ball
+            dist=np.hypot(s.x-ball.x,s.y-ball.y)-s.size
+            with np.errstate(divide='ignore'):
+                return max(float((dist/s.top_speed).min()),0.) if s.n else np.inf
+        # Time for the carrier to reach either end zone, or the edge of a watched zone
+        row=ball.carrier-1
+        dist=min(ball.x-end_zone_size,self.xsize-end_zone_size-ball.x)
+        for depth in self.zones:
+            dist=min(dist,abs(ball.x-depth),abs(self.xsize-depth-ball.x))
+        return max(dist/s.top_speed[row],0.)
+
+    def run_objectives(self):
+        """
+        Run the objective methods of the players that are due.
+
+        A player's objective runs straight away when it changes, and then at the rate the
+        method declares with player.update_rate, or every tick if it doesn't declare one, and
+        straight away for everyone when the ball changes hands (see reschedule).
+        Each player's runs are offset by a fraction of the period that depends on its pid,
+        so the work is spread evenly over the ticks. In between, the objective location it
+        last set is held.
+
+        Objective locations are double buffered. The held ones (x_target, y_target) are
+        left alone while objectives write their new location into x_objective and
+        y_objective, which are swapped in at the end. Everything else in the store is
+        frozen meanwhile, so every objective reads the same snapshot of the game whatever
+        order they run in, and they can be spread over the worker threads.
+        """
+        s=self.store
+        prof=self.profiler
+        # Back to the held objectives, prevent_friendly_collisions changes them each tick.
+        s.x_objective[:]=s.x_target
+        s.y_objective[:]=s.y_target
+        due=s.next_update <= self.time + time_eps
+        run=list()
+        for p in self.players.values():
+            objective=p.objective
+            func=getattr(objective,'__func__',objective)
+            if func is not p.scheduled or due[p._row]:
+                run.append((p,objective))
+        s.freeze(writable=('x_objective','y_objective'))
+        # Setup and bookkeeping go to the objectives phase, not to any one objective
+        prof.lap('objectives')
+        try:
+            if self.pool is None:
+                for p, objective in run:
+                    objective()
+                    prof.objective(objective.__name__)
+                    p.objective_sanity()
+                    prof.objective('objective_sanity')
+            else:
+                self.threaded=True
+                list(self.pool.map(run_objective,run))
+                prof.lap('objectives')
+        finally:
+            self.threaded=False
+            s.thaw()
+        for p, objective in run:
+            func=getattr(objective,'__func__',objective)
+            p.scheduled=func
+            rate=getattr(func,'update_rate',None)
+            if rate is None:
+                s.next_update[p._row]=self.time
+            else:
+                period=1./rate
+                phase=period*((p.pid*golden_ratio) % 1.)
+                s.next_update[p._row]=phase + period*(np.floor((self.time-phase)/period + time_eps) + 1)
+        s.x_target[:]=s.x_objective
+        s.y_target[:]=s.y_objective
+        prof.lap('objectives')
+
+    def reschedule(self,events=None):
+        """
+        Make every player's objective due on the next tick, e.g. as an event listener when
+        the ball changes hands.
+        """
+        self.store.next_update[:]=self.time
+
+    def move_players(self):
+        """
+        Move all players one tick towards their objectives.
+        """
+        if self.steering_mode == 'fmin':
+            for p in self.players.values():
+                p.move()
+            return
+        # Find the acceleration angle of all standing players not already at their
+        # objective in one go
+        s=self.store
+        m=(s.state != 0) & ((s.x_objective != s.x) | (s.y_objective != s.y))
+        if not m.any():
+            return
+        acc_angles=steering.best_acc_angles(s.x[m],s.y[m],s.angle[m],s.current_speed[m],s.acc[m],
+                                            s.top_speed[m],self.dt,s.x_objective[m],s.y_objective[m])
+        x, y, angle, speed = steering.project_moves(s.x[m],s.y[m],s.angle[m],s.current_speed[m],
+                                                    s.acc[m],s.top_speed[m],self.dt,acc_angles)
+        # Ensure players stay in bounds
+        s.x[m] = np.clip(x,0,self.xsize)
+        s.y[m] = np.clip(y,0,self.ysize)
+        s.angle[m] = angle
+        s.current_speed[m] = speed
+
+    def standup(self):
+        """
+        Count down prone players and stand up those whose time is up.
+        """
+        s=self.store
+        prone = s.state == 0
+        up = prone & (s.prone_counter <= 0)
+        s.prone_counter[prone & ~up] -= self.substeps
+        s.state[up] = 1
+        s.prone_counter[up] = -1
+
+    def check_possession(self):
+        """
+        Count turnovers, i.e. the ball being gained by the other team.
+        """
+        if self.ball.carrier == 0:
+            return
+        team = self.players[self.ball.carrier].team
+        if self.possession != 0 and team != self.possession:
+            self.turnovers += 1
+        self.possession = team
 
     def check_scoring(self):
         """
         Has a team scored?
         """
-        end_zone_size=2.
         if self.ball.carrier == 0:
             return False
         else:
             if self.ball.x < end_zone_size or self.ball.x > (self.xsize - end_zone_size):
+                self.scorer = self.players[self.ball.carrier].team
                 return True
             else:
                 return False
@@ -363,63 +905,84 @@ class Layout(object):
         """
         # Change objectives to pointing just in front of player, rather than
         # potentially a long way away.
-        for p in self.players.values():
-            angle = math.atan2(p.y_objective-p.y,p.x_objective-p.x)
-            xadd, yadd = utils.components(p.top_speed*self.dt,angle)
-            p.x_objective = p.x + xadd
-            p.y_objective = p.y + yadd
-        for thisP, thatP in itertools.combinations(self.players.values(), 2):
-            if thisP.state == 0 or thatP.state == 0:
-                continue # Prone players don't count
-            elif thisP.team != thatP.team:
-                continue # Different teams, probably WANT to collide...
-            else:
-                dist = np.sqrt( (thisP.x_objective-thatP.x_objective)**2 +\
-                                    (thisP.y_objective-thatP.y_objective)**2 )\
-                                    - thisP.size - thatP.size
-                if dist < 0:
-                    # We need to adjust the objectives.
-                    # Find mid-point of current positions
-                    cx = (thisP.x + thatP.x)/2.
-                    cy = (thisP.y + thatP.y)/2.
-                    # Find mid-point of objectives
-                    ox = (thisP.x_objective + thatP.x_objective)/2.
-                    oy = (thisP.y_objective + thatP.y_objective)/2.
-                    # Find angle of line between two objectives.
-                    hpi=2*math.atan(1.)
-                    angle = math.atan2(cy-oy,cx-ox)
-                    # Find angle of p.b. of this line
-                    pb_angle = -1/angle
-                    # Project along the p.b. line enough to seperate the two objectives
-                    pdist = -dist/2.
-                    thisx_delta, thisy_delta =  utils.components(pdist,pb_angle)
-                    thatx_delta, thaty_delta =  utils.components(pdist,pb_angle+hpi)
-                    thisP.x_objective += thisx_delta
-                    thisP.y_objective += thisy_delta
-                    thatP.x_objective += thatx_delta
-                    thatP.y_objective += thaty_delta
-                        
+        s=self.store
+        angle = np.arctan2(s.y_objective-s.y,s.x_objective-s.x)
+        s.x_objective = s.x + s.top_speed*self.dt*np.cos(angle)
+        s.y_objective = s.y + s.top_speed*self.dt*np.sin(angle)
+        # Find overlapping objectives of standing team mates, one team at a time.
+        # Prone players don't count, and different teams probably WANT to collide...
+        ilist=list()
+        jlist=list()
+        for team in np.unique(s.team):
+            rows=np.flatnonzero((s.team == team) & (s.state != 0))
+            dist=np.hypot(s.x_objective[rows,np.newaxis]-s.x_objective[rows],
+                          s.y_objective[rows,np.newaxis]-s.y_objective[rows])\
+                          - s.size[rows,np.newaxis] - s.size[rows]
+            i, j = np.nonzero(np.triu(dist < 0,k=1))
+            ilist.append(rows[i])
+            jlist.append(rows[j])
+        if len(ilist) == 0:
+            return
+        i=np.concatenate(ilist)
+        j=np.concatenate(jlist)
+        if len(i) == 0:
+            return
+        # We need to adjust the objectives.
+        # All pairs are separated in one pass from the objectives as they stand now, and each
+        # player's offsets are summed, so the result doesn't depend on the order of the pairs.
+        xo=s.x_objective.copy()
+        yo=s.y_objective.copy()
+        overlap = s.size[i] + s.size[j] - np.hypot(xo[i]-xo[j],yo[i]-yo[j])
+        # Direction of travel, from the mid-point of current positions to the mid-point
+        # of the objectives.
+        angle=np.arctan2(yo[i]+yo[j]-s.y[i]-s.y[j],xo[i]+xo[j]-s.x[i]-s.x[j])
+        # Project along the perpendicular to this enough to seperate the two objectives,
+        # each player moving to the side their objective is already on. If neither is,
+        # the lower pid goes to the left of the direction of travel.
+        nx=-np.sin(angle)
+        ny=np.cos(angle)
+        side=np.where((xo[i]-xo[j])*nx + (yo[i]-yo[j])*ny < 0,-1.,1.)
+        pdist=side*overlap/2.
+        np.add.at(s.x_objective,i,pdist*nx)
+        np.add.at(s.y_objective,i,pdist*ny)
+        np.add.at(s.x_objective,j,-pdist*nx)
+        np.add.at(s.y_objective,j,-pdist*ny)
+
     def detect_collisions(self):
         """
         Detect any collisions between objects and store a list of any.
+
+        Each player is swept along a straight line from where they started the move to
+        where they ended it, so players can't pass through each other unnoticed however
+        long the tick is. Collisions are listed in order of their time of impact, in game
+        time since the start of the tick.
         """
-        # Simple algorithm. Could speed up many times using a domain decomposition.
+        # Prone players can be run over, so only standing players are hashed.
         self.collisions=list()
-        for thisP in self.players.values():
-            for thatP in self.players.values():
-                # Ensure we don't double count collisions (i.e. by exchange of this and that)
-                if thisP.pid >= thatP.pid:
-                    continue
-                elif thisP.state == 0 or thatP.state == 0:
-                    # Prone players can be run over
-                    continue
-                else:
-                    dist = np.sqrt( (thisP.x-thatP.x)**2 + (thisP.y-thatP.y)**2 )\
-                        - thisP.size - thatP.size
-                    if dist < 0:
-                        # Collision occured
-                        collision = thisP, thatP, -dist
-                        self.collisions.append(collision)
+        s=self.store
+        standing=np.flatnonzero(s.state != 0)
+        if len(standing) < 2:
+            return
+        x0=s.x if self.x_start is None else self.x_start
+        y0=s.y if self.y_start is None else self.y_start
+        # Broadphase on the mid-points of the sweeps, cells as wide as the biggest
+        # possible contact distance plus the longest sweep
+        sweep=np.hypot(s.x[standing]-x0[standing],s.y[standing]-y0[standing])
+        grid=spatial.SpatialHash(2.*s.size[standing].max() + sweep.max())
+        grid.build((s.x[standing]+x0[standing])/2.,(s.y[standing]+y0[standing])/2.)
+        i, j = grid.pairs()
+        i, j = standing[i], standing[j]
+        # Exact test of the candidates
+        toi, gap = spatial.time_of_impact(x0[i]-x0[j],y0[i]-y0[j],s.x[i]-s.x[j],s.y[i]-s.y[j],
+                                          s.size[i]+s.size[j])
+        hit=gap < 0
+        i, j, overlap, toi = i[hit], j[hit], -gap[hit], toi[hit]*self.dt
+        # Report in order of impact, then pid
+        order=np.lexsort((j,i,toi))
+        for ii, jj, ov, t in zip(i[order].tolist(),j[order].tolist(),overlap[order].tolist(),
+                                 toi[order].tolist()):
+            # Collision occured
+            self.collisions.append((self.players[ii+1],self.players[jj+1],ov,t))
 
     def resolve_collisions(self):
         """
@@ -488,7 +1051,7 @@ class Layout(object):
         log_odds = np.log(tackle_odds)
         tackle_chance = np.exp(log_odds)/(1 + np.exp(log_odds))
         
-        roll = np.random.random()
+        roll = self.rng.random()
         if roll < tackle_chance:
             carrier.state=0
             carrier.prone_counter=tackle_count
@@ -512,11 +1075,11 @@ class Layout(object):
 
         # First determine if someone 'wins' and knocks down opponent.
         # In case of a a draw in that regard, then assess push backs.
-        win_roll=np.random.random()
+        win_roll=self.rng.random()
 
         if abs(win_roll-b1_chance) < draw_diff:
             # Draw on knock downs. See pushbacks
-            both_down_roll=np.random.random()
+            both_down_roll=self.rng.random()
             if both_down_roll < both_down_chance:
                 b1.state=0
                 b2.state=0
@@ -536,10 +1099,66 @@ class Layout(object):
                 b1.state=0
                 b1.prone_counter=block_count
 
+def run_objective(task):
+    " Run one player's objective, for Layout.run_objectives "
+    p, objective = task
+    objective()
+    p.objective_sanity()
+
+class EventBus(object):
+    """
+    Collects game events posted during a tick and passes them on to listeners.
+
+    Events are queued as they are posted and only dispatched when dispatch is called,
+    once per tick, so listeners see the state at the end of the tick. Events are
+    'caught' (pid), 'dropped' (pid), 'thrown' (pid), 'landed', 'carrier_changed'
+    (old, new), and 'ball_entered_zone' and 'ball_left_zone' (depth, end) for the zones
+    players asked to watch (see Layout.watch_zone).
+    """
+    def __init__(self):
+        self.listeners=dict()
+        self.pending=list()
+
+    def subscribe(self,event,func):
+        """
+        Call func with the list of events dispatched whenever event is among them.
+        """
+        self.listeners.setdefault(event,list()).append(func)
+
+    def post(self,event,**info):
+        """
+        Queue an event, with any details as keyword arguments.
+        """
+        self.pending.append((event,info))
+
+    def dispatch(self):
+        """
+        Pass the queued events to their listeners. Each listener is called once, however
+        many of its events were posted.
+        """
+        if not self.pending:
+            return
+        events=self.pending
+        self.pending=list()
+        called=list()
+        for event, info in events:
+            for func in self.listeners.get(event,()):
+                if func not in called:
+                    called.append(func)
+        for func in called:
+            func(events)
+
 class Trigger:
     """
     Defines triggers that could occur.
+
+    A trigger is checked whenever one of its events is dispatched (see EventBus), and
+    calls back the players using it if its condition holds. So players only rethink what
+    to do when the state of the ball changes.
     """
+    # Events that can set off the trigger
+    events=()
+
     def __init__(self,layout):
         self.layout=layout
         self.callbacks=list()
@@ -567,18 +1186,16 @@ class Trigger:
 
     def check(self):
         """
-        Check for change in condition
+        Broadcast if the condition holds
         """
         if self.condition():
             self.broadcast()
-        #cond=self.condition()
-        #if cond and not self.prev:
-        #    self.prev=True
-        #    self.broadcast()
-        #elif cond:
-        #    self.prev=True
-        #else:
-        #    self.prev=False
+
+    def notify(self,events):
+        """
+        Event listener, the game state has changed.
+        """
+        self.check()
 
     def broadcast(self):
         """
@@ -591,6 +1208,8 @@ class BallLoose(Trigger):
     """
     Ball dropped etc
     """
+    events=('dropped','landed','ball_entered_zone','ball_left_zone')
+
     def condition(self):
         if self.layout.ball.carrier ==0 and not self.layout.ball.flying:
             return True
@@ -601,6 +1220,8 @@ class BallHeld(BallLoose):
     """
     Someone has the ball
     """
+    events=('carrier_changed','ball_entered_zone','ball_left_zone')
+
     # simply reverse the BallLoose condition
     def condition(self):
         if self.layout.ball.carrier ==0:
@@ -612,6 +1233,8 @@ class BallFlying(Trigger):
     """
     Ball in the air.
     """
+    events=('thrown',)
+
     def condition(self):
         return self.layout.ball.flying
 